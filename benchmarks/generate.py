@@ -0,0 +1,202 @@
+"""
+Deterministic synthetic cohorts for the benchmarks.
+
+Each generator writes the files of a cohort of n samples in the layout of
+the fixtures under tests/, so that the plugin modules find and parse them
+like real pipeline outputs:
+
+    ALFA       samples/<sample>/ALFA/{Unique,UniqueMultiple}/
+                   <sample>.ALFA_feature_counts.tsv
+    tin-score  samples/<sample>/TIN/TIN_score.tsv and/or
+               TIN_scores_merged.tsv
+    zpca       PCA.tsv and scree.tsv
+
+The same arguments always give the same files.
+
+    python benchmarks/generate.py tin-score 1000 /tmp/tin-1000
+"""
+
+from __future__ import print_function
+import argparse
+import os
+
+import numpy as np
+
+# Categories and biotypes of the ALFA fixtures with the counts and genome
+# sizes of one of their samples
+ALFA_FEATURES = [
+    ("intergenic,intergenic", 4982204.348537906, 3021199.0),
+    ("opposite_strand,opposite_strand", 579808.745410019, 8826348.0),
+    ("start_codon,protein_coding", 155958.24355000013, 19709.0),
+    ("CDS,protein_coding", 43425394.6267014, 8698652.0),
+    ("stop_codon,protein_coding", 112455.97096000066, 19754.0),
+    ("intron,protein_coding", 109302.0997900005, 66684.0),
+    ("exon,tRNA", 2139.5859899999987, 21666.0),
+    ("intron,tRNA", 102.56720999999997, 1459.0),
+    ("ambiguous,ambiguous", 8156.0024399999875, 5093.0),
+    ("exon,transposable_element", 16085.776389999945, 241037.0),
+    ("exon,snoRNA", 56303.75048000009, 12358.0),
+    ("exon,pseudogene", 1151.1506899999997, 10300.0),
+    ("exon,ncRNA", 22439.512389999993, 14574.0),
+    ("five_prime_utr,protein_coding", 243.05947, 8.0),
+    ("exon,snRNA", 18522.524979999987, 2229.0),
+    ("exon,rRNA", 3279.0900199999955, 19229.0),
+    ("intron,snoRNA", 75.21304, 223.0),
+    ("intron,rRNA", 275.7186, 435.0),
+    ("transcript,protein_coding", 430.58458999999993, 2496.0),
+]
+
+TIN_LAYOUTS = ("samples", "merged", "both")
+
+
+def sample_names(n: int):
+    """
+    Names of the samples of a cohort, in the "<condition>_rep<k>_<condition>"
+    form of the fixtures, with up to ten replicates per condition.
+    """
+    conditions = max(1, -(-n // 10))
+    return [
+        f"cond{k % conditions + 1}_rep{k // conditions + 1}_cond{k % conditions + 1}"
+        for k in range(n)
+    ]
+
+
+def write_alfa(root: str, n: int, seed: int = 0):
+    """
+    Writes the Unique and UniqueMultiple ALFA feature counts of n samples.
+    """
+    rng = np.random.default_rng(seed)
+    labels = [label for label, _, _ in ALFA_FEATURES]
+    counts = np.array([count for _, count, _ in ALFA_FEATURES])
+    sizes = np.array([size for _, _, size in ALFA_FEATURES])
+
+    for sample in sample_names(n):
+        unique = counts * rng.lognormal(0.0, 0.25, len(counts))
+        multiple = unique * rng.uniform(1.0, 1.2, len(counts))
+        for folder, values in (("Unique", unique), ("UniqueMultiple", multiple)):
+            path = os.path.join(root, "samples", sample, "ALFA", folder)
+            os.makedirs(path, exist_ok=True)
+            rows = [
+                f"{label}\t{value!r}\t{size!r}\n"
+                for label, value, size in zip(labels, values.tolist(), sizes.tolist())
+            ]
+            with open(
+                os.path.join(path, f"{sample}.ALFA_feature_counts.tsv"), "w"
+            ) as fh:
+                fh.write("#Category,biotype\tCounts_in_BAM/BedGraph\tSize_in_genome\n")
+                fh.writelines(rows)
+
+
+def tin_scores(n: int, transcripts: int, seed: int = 0):
+    """
+    Transcripts x samples matrix of TIN scores distributed like those of
+    the fixtures: mostly high with a long tail towards 0 and about 1% of
+    zeros.
+    """
+    rng = np.random.default_rng(seed)
+    scores = 100 * rng.beta(5.0, 1.0, (transcripts, n))
+    scores[rng.random((transcripts, n)) < 0.01] = 0.0
+    return scores
+
+
+def write_tin_score(
+    root: str, n: int, transcripts: int = 1000, layout: str = "samples", seed: int = 0
+):
+    """
+    Writes the TIN scores of n samples as per-sample TIN_score.tsv files, a
+    TIN_scores_merged.tsv matrix or both.
+    """
+    if layout not in TIN_LAYOUTS:
+        raise ValueError(
+            f"unknown TIN layout '{layout}', expected one of {TIN_LAYOUTS}"
+        )
+    samples = sample_names(n)
+    names = [f"T{i:06d}_mRNA" for i in range(transcripts)]
+    scores = tin_scores(n, transcripts, seed)
+
+    if layout in ("samples", "both"):
+        for j, sample in enumerate(samples):
+            path = os.path.join(root, "samples", sample, "TIN")
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, "TIN_score.tsv"), "w") as fh:
+                fh.write(f"transcript\t{sample}\n")
+                fh.writelines(
+                    f"{name}\t{score!r}\n"
+                    for name, score in zip(names, scores[:, j].tolist())
+                )
+
+    if layout in ("merged", "both"):
+        os.makedirs(root, exist_ok=True)
+        with open(os.path.join(root, "TIN_scores_merged.tsv"), "w") as fh:
+            fh.write("\t".join(["transcript"] + samples) + "\n")
+            for name, row in zip(names, scores.tolist()):
+                fh.write("\t".join([name] + [repr(score) for score in row]) + "\n")
+
+
+def write_zpca(root: str, n: int, components: int = 10, seed: int = 0):
+    """
+    Writes the PCA.tsv coordinates and scree.tsv explained variances of a
+    PCA of n samples, with one cluster of samples per condition.
+    """
+    rng = np.random.default_rng(seed)
+    samples = sample_names(n)
+    components = max(2, min(components, n))
+    header = "\t" + "\t".join(f"PC{i + 1}" for i in range(components)) + "\n"
+
+    # Decreasing spread along the components, clustered by condition
+    spread = 50.0 / np.arange(1, components + 1)
+    conditions = np.array([sample.split("_")[0] for sample in samples])
+    _, condition = np.unique(conditions, return_inverse=True)
+    centres = rng.normal(0.0, 1.0, (condition.max() + 1, components)) * spread
+    coordinates = centres[condition] + rng.normal(0.0, 0.3, (n, components)) * spread
+
+    explained = 100 * spread**2 / (spread**2).sum() * 0.9
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, "PCA.tsv"), "w") as fh:
+        fh.write(header)
+        fh.writelines(
+            sample + "\t" + "\t".join(repr(value) for value in row) + "\n"
+            for sample, row in zip(samples, coordinates.tolist())
+        )
+    with open(os.path.join(root, "scree.tsv"), "w") as fh:
+        fh.write(header)
+        fh.write(
+            "Percentage of Explained Variance\t"
+            + "\t".join(f"{value:.1f}" for value in explained)
+            + "\n"
+        )
+
+
+GENERATORS = {"ALFA": write_alfa, "tin-score": write_tin_score, "zpca": write_zpca}
+
+
+def main(argv: list = None):
+    """
+    Command line interface to write a synthetic cohort.
+    """
+    parser = argparse.ArgumentParser(description="Write a synthetic cohort.")
+    parser.add_argument("module", choices=sorted(GENERATORS))
+    parser.add_argument("samples", type=int)
+    parser.add_argument("root")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--transcripts", type=int, default=1000, help="tin-score: transcripts"
+    )
+    parser.add_argument(
+        "--tin-layout", choices=TIN_LAYOUTS, default="samples", help="tin-score"
+    )
+    parser.add_argument("--components", type=int, default=10, help="zpca")
+    args = parser.parse_args(argv)
+
+    if args.module == "ALFA":
+        write_alfa(args.root, args.samples, seed=args.seed)
+    elif args.module == "tin-score":
+        write_tin_score(
+            args.root, args.samples, args.transcripts, args.tin_layout, seed=args.seed
+        )
+    else:
+        write_zpca(args.root, args.samples, args.components, seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+"""
+Scaling benchmarks of the plugin modules.
+
+Runs MultiQC with one plugin module on synthetic cohorts (see generate.py)
+of increasing size and records the wall time and peak RSS of each phase of
+the run:
+
+    discovery  searching the files (report.get_filelist)
+    parse      parsing the files found (parse_files)
+    compute    the rest of the module: aggregation, statistics and the
+               preparation of the plot data
+    plot       building the plots (bargraph/linegraph/scatter.plot)
+    other      MultiQC setup and writing the report
+
+Every run is a separate process, so that the peak RSS of one run does not
+carry over to the next. The peak RSS of each phase is measured by resetting
+the peak of the process at the start of the phase (Linux); elsewhere it is
+the peak of the process so far.
+
+The results are written as JSON and can be compared against a baseline to
+catch regressions before a release:
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --samples 10 100 --compare benchmarks/baseline.json
+"""
+
+from __future__ import print_function
+from collections import defaultdict
+import argparse
+import functools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate
+
+MODULES = ("ALFA", "tin-score", "zpca")
+SAMPLES = (10, 100, 1000, 10000)
+PHASES = ("discovery", "parse", "compute", "plot", "other")
+PLUGIN_PHASES = PHASES[:-1]
+PLOTS = ("interactive", "flat", "default")
+
+# A phase only counts as a regression if it is slower by more than the
+# relative tolerance and by more than these absolute margins
+MIN_SECONDS = 0.05
+MIN_RSS_MB = 5.0
+
+
+class PhaseRecorder(object):
+    """
+    Attributes the wall time and peak RSS of a run to phases. Phases nest:
+    the time spent in an inner phase is not counted in the outer one.
+    """
+
+    def __init__(self):
+        self.wall = defaultdict(float)
+        self.peak = defaultdict(float)
+        self.stack = ["other"]
+        self._start()
+
+    def _start(self):
+        self.started = time.perf_counter()
+        _reset_peak_rss()
+
+    def _stop(self):
+        phase = self.stack[-1]
+        self.wall[phase] += time.perf_counter() - self.started
+        self.peak[phase] = max(self.peak[phase], _peak_rss_mb())
+
+    def wrap(self, phase: str, func):
+        """
+        Wraps a function so that its calls are recorded as the phase.
+        """
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            self._stop()
+            self.stack.append(phase)
+            self._start()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._stop()
+                self.stack.pop()
+                self._start()
+
+        return wrapper
+
+    def results(self):
+        """
+        Stops the current phase and returns the {phase: {wall_seconds,
+        peak_rss_mb}} dictionary of the run.
+        """
+        self._stop()
+        self._start()
+        return {
+            phase: {
+                "wall_seconds": round(self.wall[phase], 4),
+                "peak_rss_mb": round(self.peak[phase], 1),
+            }
+            for phase in PHASES
+        }
+
+
+def _reset_peak_rss():
+    """
+    Resets the peak RSS of the process to its current RSS, where supported.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    """
+    Peak RSS of the process in MB.
+    """
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_once(module: str, root: str, plots: str = "interactive"):
+    """
+    Runs MultiQC with a single module on a cohort in this process and
+    returns the measurements of its phases.
+    """
+    import multiqc
+    from multiqc.plots import bargraph, heatmap, linegraph, scatter, table
+    from multiqc.utils import report
+
+    import modules.ALFA
+    import modules.ALFA.ALFA
+    import modules.tin_score
+    import modules.tin_score.tin_score
+    import modules.zpca
+    import modules.zpca.zpca
+
+    recorder = PhaseRecorder()
+    report.get_filelist = recorder.wrap("discovery", report.get_filelist)
+    for plot_type in (bargraph, heatmap, linegraph, scatter, table):
+        plot_type.plot = recorder.wrap("plot", plot_type.plot)
+    for package, main in (
+        (modules.ALFA, modules.ALFA.ALFA),
+        (modules.tin_score, modules.tin_score.tin_score),
+        (modules.zpca, modules.zpca.zpca),
+    ):
+        main.parse_files = recorder.wrap("parse", main.parse_files)
+        cls = package.MultiqcModule
+        cls.__init__ = recorder.wrap("compute", cls.__init__)
+
+    with tempfile.TemporaryDirectory() as outdir:
+        start = time.perf_counter()
+        multiqc.run(
+            root,
+            module=(module,),
+            outdir=outdir,
+            force=True,
+            quiet=True,
+            plots_interactive=plots == "interactive",
+            plots_flat=plots == "flat",
+        )
+        total = time.perf_counter() - start
+
+    phases = recorder.results()
+    phases["total"] = {
+        "wall_seconds": round(total, 4),
+        "peak_rss_mb": round(max(p["peak_rss_mb"] for p in phases.values()), 1),
+    }
+    return phases
+
+
+def cohort(workdir: str, module: str, samples: int, args):
+    """
+    Returns the directory of a synthetic cohort, writing it unless it was
+    written with the same arguments before.
+    """
+    options = {"seed": args.seed}
+    if module == "tin-score":
+        options.update(transcripts=args.transcripts, layout=args.tin_layout)
+    elif module == "zpca":
+        options.update(components=args.components)
+    name = "-".join([module, str(samples)] + [f"{k}={v}" for k, v in options.items()])
+    root = os.path.join(workdir, name)
+    if not os.path.exists(os.path.join(root, ".complete")):
+        generate.GENERATORS[module](root, samples, **options)
+        open(os.path.join(root, ".complete"), "w").close()
+    return root
+
+
+def run_child(module: str, root: str, plots: str):
+    """
+    Runs MultiQC on a cohort in a child process and returns the
+    measurements of its phases, or None if the run failed.
+    """
+    with tempfile.NamedTemporaryFile(suffix=".json") as output:
+        child = subprocess.run(
+            [sys.executable, __file__, "--single", module, root, output.name]
+            + ["--plots", plots],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            env=dict(os.environ, PYTHONPATH=_repository()),
+        )
+        if child.returncode:
+            sys.stderr.write(child.stderr)
+            return None
+        with open(output.name) as fh:
+            return json.load(fh)
+
+
+def best(runs: list):
+    """
+    Combines repeated runs into the lowest wall time and peak RSS of each
+    phase, which are the least affected by other load on the machine.
+    """
+    return {
+        phase: {key: min(run[phase][key] for run in runs) for key in runs[0][phase]}
+        for phase in runs[0]
+    }
+
+
+def compare(results: list, baseline: list, tolerance: float):
+    """
+    Returns a description of each phase of the plugins that is slower or
+    uses more memory than in the baseline beyond the tolerance. The "other"
+    phase and the total are left out: they mostly measure MultiQC itself.
+    """
+    base = {(r["module"], r["samples"], r["phase"]): r for r in baseline}
+    regressions = []
+    for r in results:
+        b = base.get((r["module"], r["samples"], r["phase"]))
+        if b is None or r["phase"] not in PLUGIN_PHASES:
+            continue
+        for key, margin in (("wall_seconds", MIN_SECONDS), ("peak_rss_mb", MIN_RSS_MB)):
+            if r[key] > b[key] * (1 + tolerance) and r[key] - b[key] > margin:
+                regressions.append(
+                    f"{r['module']} {r['samples']} samples {r['phase']}: "
+                    f"{key} {b[key]} -> {r[key]}"
+                )
+    return regressions
+
+
+def machine():
+    """
+    Description of the machine and software the benchmarks ran on.
+    """
+    import multiqc
+    import numpy
+
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "multiqc": multiqc.__version__,
+    }
+
+
+def main(argv: list = None):
+    """
+    Command line interface of the benchmarks.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the plugin modules.")
+    parser.add_argument("--modules", nargs="+", choices=MODULES, default=MODULES)
+    parser.add_argument("--samples", nargs="+", type=int, default=SAMPLES)
+    parser.add_argument(
+        "--workdir",
+        default=os.path.join(tempfile.gettempdir(), "multiqc-plugins-benchmarks"),
+        help="directory of the synthetic cohorts, kept between runs",
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="relative slowdown or memory increase reported as a regression",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="runs per module and size, keeping the best of each phase",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--transcripts", type=int, default=1000)
+    parser.add_argument("--tin-layout", choices=generate.TIN_LAYOUTS, default="samples")
+    parser.add_argument("--components", type=int, default=10)
+    parser.add_argument(
+        "--plots",
+        choices=PLOTS,
+        default="interactive",
+        help="plot type; with 'default', MultiQC renders the plots of more "
+        "than 100 samples as images, which then dominates the run time",
+    )
+    parser.add_argument("--single", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    # Child process: a single run, written to a JSON file
+    if args.single:
+        module, root, output = args.single
+        with open(output, "w") as fh:
+            json.dump(run_once(module, root, args.plots), fh)
+        return 0
+
+    options = {
+        key: getattr(args, key)
+        for key in (
+            "seed",
+            "transcripts",
+            "tin_layout",
+            "components",
+            "plots",
+            "repeat",
+        )
+    }
+    results = []
+    for module in args.modules:
+        for samples in args.samples:
+            root = cohort(args.workdir, module, samples, args)
+            runs = []
+            for _ in range(args.repeat):
+                phases = run_child(module, root, args.plots)
+                if phases is None:
+                    return 1
+                runs.append(phases)
+            phases = best(runs)
+            for phase, values in phases.items():
+                results.append(
+                    dict(module=module, samples=samples, phase=phase, **values)
+                )
+            print(
+                f"{module:>9} {samples:>6} samples: "
+                + ", ".join(
+                    f"{phase} {phases[phase]['wall_seconds']:.3f}s "
+                    f"{phases[phase]['peak_rss_mb']:.0f} MB"
+                    for phase in PHASES + ("total",)
+                ),
+                flush=True,
+            )
+
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(
+                {"machine": machine(), "options": options, "results": results},
+                fh,
+                indent=2,
+                sort_keys=True,
+            )
+            fh.write("\n")
+
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.compare}")
+    return 0
+
+
+def _repository():
+    """
+    Root of the repository, so that the child processes import the plugin
+    modules from the working tree.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")]))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+"""
+Startup benchmarks of the plugins.
+
+Pipelines run MultiQC with a single module in many small steps, where the
+start of MultiQC weighs as much as the modules' work. Each measurement runs
+in a fresh process:
+
+    hook       importing the execution_start hook, which MultiQC loads on
+               every run, and running it for a single module
+    import     importing a module once MultiQC is imported
+    empty run  a whole "multiqc -m <module>" run on an empty directory
+
+The import times are read from "python -X importtime" and only count the
+modules that were not imported yet. A module importing matplotlib (through
+the MultiQC plot modules) before it has something to plot is reported.
+
+    python benchmarks/startup.py --output startup.json
+    python benchmarks/startup.py --compare benchmarks/startup_baseline.json
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from run import _repository, machine
+
+# Plugin modules and the packages holding them
+MODULES = {
+    "ALFA": "modules.ALFA",
+    "tin-score": "modules.tin_score",
+    "zpca": "modules.zpca",
+}
+
+# A measurement only counts as a regression if it is slower by more than
+# the relative tolerance and by more than this absolute margin
+MIN_SECONDS = 0.02
+
+# Runs the execution_start hook for one module and prints its duration
+HOOK_SCRIPT = """
+import time
+from multiqc.utils import config
+import modules.hook
+config.run_modules = ({module!r},)
+start = time.perf_counter()
+modules.hook.execution_start()
+print(time.perf_counter() - start)
+"""
+
+
+def _python(args: list):
+    """
+    Runs the Python interpreter with the plugins of the working tree and
+    returns the completed process.
+    """
+    child = subprocess.run(
+        [sys.executable] + args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        env=dict(os.environ, PYTHONPATH=_repository()),
+    )
+    if child.returncode:
+        sys.stderr.write(child.stderr)
+        raise RuntimeError(f"python {' '.join(args)} failed")
+    return child
+
+
+def import_times(statement: str):
+    """
+    Runs the statement with "-X importtime" and returns the cumulative
+    import time in seconds of each module it imported.
+    """
+    times = dict()
+    for line in _python(["-X", "importtime", "-c", statement]).stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def measure(module: str, empty_dir: str):
+    """
+    Returns the startup measurements of a module.
+    """
+    package = MODULES[module]
+    hook = import_times("import multiqc.multiqc")
+    imported = import_times(f"import multiqc.multiqc; import {package}")
+    hook_run = float(_python(["-c", HOOK_SCRIPT.format(module=module)]).stdout)
+
+    with tempfile.TemporaryDirectory() as outdir:
+        start = time.perf_counter()
+        _python(["-m", "multiqc", "-m", module, empty_dir, "-o", outdir, "-f", "-q"])
+        empty_run = time.perf_counter() - start
+
+    return {
+        "hook_import_seconds": round(hook.get("modules.hook", 0.0), 4),
+        "hook_run_seconds": round(hook_run, 4),
+        "import_seconds": round(imported[package], 4),
+        "empty_run_seconds": round(empty_run, 4),
+        "imports_matplotlib": "matplotlib" in set(imported) - set(hook),
+    }
+
+
+def best(runs: list):
+    """
+    Combines repeated measurements into the lowest of each time.
+    """
+    return {
+        key: min(run[key] for run in runs) if key.endswith("_seconds") else value
+        for key, value in runs[0].items()
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """
+    Returns a description of each measurement that is slower than in the
+    baseline beyond the tolerance, and of each module that imports
+    matplotlib when it did not in the baseline.
+    """
+    regressions = []
+    for module, values in results.items():
+        base = baseline.get(module)
+        if base is None:
+            continue
+        for key, value in values.items():
+            if key not in base:
+                continue
+            if key == "imports_matplotlib":
+                if value and not base[key]:
+                    regressions.append(f"{module}: imports matplotlib on import")
+            elif (
+                value > base[key] * (1 + tolerance) and value - base[key] > MIN_SECONDS
+            ):
+                regressions.append(f"{module} {key}: {base[key]} -> {value}")
+    return regressions
+
+
+def main(argv: list = None):
+    """
+    Command line interface of the startup benchmarks.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the plugins' startup.")
+    parser.add_argument("--modules", nargs="+", choices=MODULES, default=list(MODULES))
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="relative slowdown reported as a regression",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="measurements per module, keeping the fastest",
+    )
+    args = parser.parse_args(argv)
+
+    results = dict()
+    with tempfile.TemporaryDirectory() as empty_dir:
+        for module in args.modules:
+            results[module] = best(
+                [measure(module, empty_dir) for _ in range(args.repeat)]
+            )
+            values = results[module]
+            print(
+                f"{module:>9}: hook import {values['hook_import_seconds']:.3f}s, "
+                f"hook run {values['hook_run_seconds']:.4f}s, "
+                f"import {values['import_seconds']:.3f}s, "
+                f"empty run {values['empty_run_seconds']:.3f}s"
+                + (", imports matplotlib" if values["imports_matplotlib"] else ""),
+                flush=True,
+            )
+
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(
+                {"machine": machine(), "results": results},
+                fh,
+                indent=2,
+                sort_keys=True,
+            )
+            fh.write("\n")
+
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.compare}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,13 +13,60 @@
 from __future__ import print_function
 import logging
 import os
+import re
 
-from multiqc.plots import bargraph
+import numpy as np
 from multiqc.modules.base_module import BaseMultiqcModule
-import math
+from multiqc.utils import config
+
+from .matrix import FeatureGroups, FeatureMatrix
+from ..cache import ParseCache
+from ..compaction import PlotCompactor, plot_id
+from ..export import Exporter
+from ..parallel import parse_files, parse_workers
+from ..parsing import (
+    Column,
+    ParseStats,
+    Schema,
+    group_sum,
+    read_log,
+)
+from ..prefetch import Prefetcher
+from ..profiling import PhaseProfile
+
+# Initialise the logger under the "multiqc" logger so that it reaches its handlers
+log = logging.getLogger(f"multiqc.{__name__}")
+
+# Layout of the *ALFA_feature_counts.tsv files
+ALFA_SCHEMA = Schema(
+    [
+        Column("#Category,biotype", str),
+        Column("Counts_in_BAM/BedGraph", np.float64),
+        Column("Size_in_genome", np.float64),
+    ]
+)
+
+# Header line of the ALFA feature counts files, checked before parsing
+ALFA_HEADER = re.compile(r"#Category,biotype\t")
+
+
+def parse_alfa_logs(f: dict, stats: ParseStats = None):
+    """
+    Parses an ALFA file and returns the categories' and biotypes'
+    aggregated values, each as a (names, counts, sizes) tuple of arrays.
+    This is a module-level function so that it can run in parse workers.
+    """
+    table = read_log(f, ALFA_SCHEMA, stats=stats)
+    # Each row is labelled with "category,biotype"
+    labels = np.char.partition(table[0], ",")
+
+    aggregated = []
+    for keys in (labels[:, 0], labels[:, 2]):
+        names, counts = group_sum(keys, table[1])
+        names, sizes = group_sum(keys, table[2])
+        aggregated.append((names.tolist(), counts, sizes))
 
-# Initialise the logger
-log = logging.getLogger(__name__)
+    return aggregated
 
 
 class MultiqcModule(BaseMultiqcModule):
@@ -48,112 +95,131 @@ class MultiqcModule(BaseMultiqcModule):
                 whatever the organism.",
         )
 
-        self.folders = []
-        self.find_parent_folders()
+        # Module options, set under "ALFA_config" in the MultiQC config
+        alfa_config = getattr(config, "ALFA_config", {})
+        self.on_duplicate = alfa_config.get("on_duplicate", "first")
+        # Conditions: samples are grouped by the first group (or the whole
+        # match) of group_regex in their names, samples not matching it are
+        # a group of their own. Above group_threshold samples in a folder,
+        # or always if group_samples is true, the conditions are plotted
+        # instead of the samples, unless plot_samples is true
+        self.group_regex = re.compile(alfa_config.get("group_regex", r"^(.+?)_rep\d+"))
+        self.group_samples = alfa_config.get("group_samples", "auto")
+        self.group_threshold = alfa_config.get("group_threshold", 100)
+        self.plot_samples = alfa_config.get("plot_samples", False)
+        self.parse_workers = parse_workers(alfa_config)
+        self.cache = ParseCache.from_config(getattr(config, "plugin_parse_cache", None))
+        self.profile = PhaseProfile.from_config(
+            getattr(config, "plugin_profiling", None)
+        )
+        self.exporter = Exporter.from_config(
+            getattr(config, "plugin_export", None), config.data_dir
+        )
+        self.compactor = PlotCompactor.from_config(
+            getattr(config, "plugin_compaction", None)
+        )
+        self.prefetcher = Prefetcher.from_config(
+            getattr(config, "plugin_prefetch", None)
+        )
 
-        for folder in self.folders:
+        self.parse_stats = ParseStats()
+        self.folders = dict()
+        with self.profile.phase("find") as found:
+            self.find_parent_folders()
+            found.files += sum(len(files) for files in self.folders.values())
+
+        for folder, files in self.folders.items():
             self.reset()
-            self.findLogs(folder)
-            self.calculatePercentage()
-            self.calculateEnrichment()
-            self.print_alfa_charts(
-                folder=folder, data=self.categories, kind="Categories"
+            self.findLogs(files)
+            with self.profile.phase("compute"):
+                self.calculatePercentage()
+                self.calculateEnrichment()
+                grouped = self.is_grouped()
+                if grouped:
+                    self.calculateGroups()
+            with self.profile.phase("export"):
+                self.export_matrices(folder)
+            with self.profile.phase("sections"):
+                if grouped:
+                    self.print_alfa_charts(
+                        folder=folder, data=self.category_groups, kind="Categories"
+                    )
+                    self.print_alfa_charts(
+                        folder=folder, data=self.biotype_groups, kind="Biotypes"
+                    )
+                if not grouped or self.plot_samples:
+                    self.print_alfa_charts(
+                        folder=folder, data=self.categories, kind="Categories"
+                    )
+                    self.print_alfa_charts(
+                        folder=folder, data=self.biotypes, kind="Biotypes"
+                    )
+
+        if self.parse_stats.files:
+            log.info(self.parse_stats.summary())
+        if self.cache is not None:
+            log.info(self.cache.summary())
+            self.cache.close()
+        if self.exporter.written:
+            log.info(self.exporter.summary())
+        if self.compactor.plots:
+            log.info(self.compactor.summary())
+        if self.prefetcher.files:
+            log.info(self.prefetcher.summary())
+        if self.profile.enabled:
+            log.info(self.profile.summary())
+            self.write_data_file(
+                self.profile.to_dict(), "multiqc_ALFA_profile", data_format="json"
             )
-            self.print_alfa_charts(folder=folder, data=self.biotypes, kind="Biotypes")
 
     def find_parent_folders(self):
         """
-        Finds the parent folders of log files to create a section for each folder
-        in multiQC report.
+        Finds the log files in a single pass and groups them by their parent
+        folder, to create a section for each folder in multiQC report.
         """
-        for f in self.find_log_files("ALFA"):
-            if os.path.basename(f["root"]) not in self.folders:
-                self.folders = self.folders + [os.path.basename(f["root"])]
+        files = list(self.find_log_files("ALFA", filecontents=False))
+        for f, match in zip(files, self.prefetcher.sniff(files, ALFA_HEADER)):
+            if not match:
+                log.debug(f"Skipping {f['fn']}: not an ALFA feature counts file")
+                continue
+            self.folders.setdefault(os.path.basename(f["root"]), []).append(f)
+
+        if not self.folders:
+            raise UserWarning
 
     def reset(self):
         """
         Resets the required variables in order to make them ready
         for the parsing other folders.
         """
-        self.alfa_data = dict()
-        self.alfa_data["temp"] = {}
-
-        self.categories = dict()
-        self.categories["temp"] = {}
-
-        self.biotypes = dict()
-        self.biotypes["temp"] = {}
-
-        self.categories_enrich = dict()
-        self.categories_enrich["temp"] = {}
-
-        self.biotypes_enrich = dict()
-        self.biotypes_enrich["temp"] = {}
-
-        self.categories_percent = dict()
-        self.categories_percent["temp"] = {}
-
-        self.biotypes_percent = dict()
-        self.biotypes_percent["temp"] = {}
-
-        self.categories_size = dict()
-        self.categories_size["temp"] = {}
-
-        self.biotypes_size = dict()
-        self.biotypes_size["temp"] = {}
-
-        self.categories_size_percent = dict()
-        self.categories_size_percent["temp"] = {}
-
-        self.biotypes_size_percent = dict()
-        self.biotypes_size_percent["temp"] = {}
-
-        self.categories_temp = dict()
-        self.categories_temp["temp"] = {}
-
-        self.biotypes_temp = dict()
-        self.biotypes_temp["temp"] = {}
-
-        self.categories_size_temp = dict()
-        self.categories_size_temp["temp"] = {}
-
-        self.biotypes_size_temp = dict()
-        self.biotypes_size_temp["temp"] = {}
+        self.categories = FeatureMatrix()
+        self.biotypes = FeatureMatrix()
+        self.category_groups = None
+        self.biotype_groups = None
 
         # Number of ALFA reports
         self.number = 0
 
-        # To keep track of all the parsed files
-        self.filesDone = []
-
-    def findLogs(self, folder: str):
+    def findLogs(self, files: list):
         """
-        Find files matching with the regex in ALFA/custom_code.py and
-        calls iterates through all these files and calls parse_alfa_logs()
-        and updateDictValues() for each file.
+        Parses the log files found for a folder with parse_alfa_logs(),
+        in parallel if "parse_workers" is set, and calls
+        updateDictValues() for each file in the order they were found.
         """
-        for f in self.find_log_files("ALFA"):
-            if os.path.basename(f["root"]) == folder:
-                filename = self.get_filename(f)
-
-                if filename not in self.filesDone:
-                    self.number = self.number + 1
-                    self.filesDone = self.filesDone + [filename]
-                    (
-                        self.categories_temp,
-                        self.biotypes_temp,
-                        self.categories_size_temp,
-                        self.biotypes_size_temp,
-                    ) = self.parse_alfa_logs(f, filename)
-                    self.updateDictValues(
-                        self.categories_temp,
-                        self.biotypes_temp,
-                        self.categories_size_temp,
-                        self.biotypes_size_temp,
-                    )
-
-                if self.number == 0:
-                    raise UserWarning
+        with self.profile.phase("parse", stats=self.parse_stats):
+            parsed = parse_files(
+                parse_alfa_logs,
+                files,
+                self.parse_workers,
+                self.parse_stats,
+                cache=self.cache,
+                namespace="ALFA",
+                prefetcher=self.prefetcher,
+            )
+        with self.profile.phase("compute"):
+            for f, (categories, biotypes) in zip(files, parsed):
+                self.number = self.number + 1
+                self.updateDictValues(self.get_filename(f), categories, biotypes)
 
     def get_filename(self, f: dict):
         """
@@ -165,167 +231,106 @@ class MultiqcModule(BaseMultiqcModule):
         part1 = fullFilename[0:part2]
         return part1
 
-    def parse_alfa_logs(self, f: dict, filename: str):
+    def updateDictValues(self, filename: str, categories: tuple, biotypes: tuple):
         """
-        Iterates through a file and stores biotypes' and categories'
-        aggregated values in appropriate dictionaries.
+        Takes categories and biotypes data parsed from one file and
+        upserts them as the file's row of the categories and biotypes
+        matrices. A sample found in several files of a folder is handled
+        according to the "on_duplicate" option (first, replace, sum or
+        error), with a warning for each of the two matrices.
         """
-        word = []
-        words = []
-        listToStr1 = []
-        listToStr = []
-
-        for char in f["f"]:
-            if char != "\t" and char != "\n":
-                word.append(char)
-            else:
-                words.append(word)
-                word = []
-
-        # Concatinating each character
-        for k in words:
-            listToStr1.append("".join([str(elem) for elem in k]))
-        # Conactinating each word
-        for k in listToStr1:
-            listToStr.append("".join([str(elem) for elem in k]))
-
-        catdict = dict()
-        catdict["temp"] = {}
-
-        biodict = dict()
-        biodict["temp"] = {}
-
-        catdict_size = dict()
-        catdict["temp"] = {}
-
-        biodict_size = dict()
-        biodict["temp"] = {}
-
-        # Adding tsv values to a dictionary
-        for i_num in range(len(listToStr)):
-            if i_num < 3:
-                continue
-            elif i_num % 3 == 0:
-                cat, bio = listToStr[i_num].split(",")
-
-                catdict.setdefault(filename, {})
-                biodict.setdefault(filename, {})
-
-                catdict[filename].setdefault(cat, 0)
-                biodict[filename].setdefault(bio, 0)
-
-                catdict_size.setdefault(filename, {})
-                biodict_size.setdefault(filename, {})
-
-                catdict_size[filename].setdefault(cat, 0)
-                biodict_size[filename].setdefault(bio, 0)
-
-                catdict[filename][cat] = catdict[filename][cat] + float(
-                    listToStr[i_num + 1]
-                )
-                biodict[filename][bio] = biodict[filename][bio] + float(
-                    listToStr[i_num + 1]
+        for kind, matrix, values in (
+            ("categories", self.categories, categories),
+            ("biotypes", self.biotypes, biotypes),
+        ):
+            if matrix.add(filename, *values, on_duplicate=self.on_duplicate):
+                log.warning(
+                    f"Sample '{filename}' found more than once in the {kind}, "
+                    f"applied the '{self.on_duplicate}' policy"
                 )
 
-                catdict_size[filename][cat] = catdict_size[filename][cat] + float(
-                    listToStr[i_num + 2]
-                )
-                biodict_size[filename][bio] = biodict_size[filename][bio] + float(
-                    listToStr[i_num + 2]
-                )
-        return catdict, biodict, catdict_size, biodict_size
-
-    def updateDictValues(
-        self,
-        categories_temp: dict,
-        biotypes_temp: dict,
-        categories_size_temp: dict,
-        biotypes_size_temp: dict,
-    ):
+    def export_matrices(self, folder: str):
         """
-        Takes categories and biotypes data from dictonaries containg values
-        from one file and add them into the the dictionaries previously
-        parsed after matching with the dictionary keys.
+        Writes the counts, sizes, percentages and enrichments of the
+        categories and biotypes of a folder as samples x features matrices.
         """
-        if "temp" in self.categories:
-            del self.categories["temp"]
-        if "temp" in self.biotypes:
-            del self.biotypes["temp"]
-        del categories_temp["temp"]
-        del biotypes_temp["temp"]
-
-        if "temp" in self.categories_size:
-            del self.categories_size["temp"]
-        if "temp" in self.biotypes_size:
-            del self.biotypes_size["temp"]
-        # Combining both the dictionaries
-        for i in categories_temp.keys():
-            found = 0
-            for j in self.categories.keys():
-                if i == j:
-                    found = 1
-                    self.categories[j].update(categories_temp[i])
-            if found == 0:
-                self.categories[i] = categories_temp[i]
-
-        for i in biotypes_temp.keys():
-            found = 0
-            for j in self.biotypes.keys():
-                if i == j:
-                    found = 1
-                    self.biotypes[j].update(biotypes_temp[i])
-            if found == 0:
-                self.biotypes[i] = biotypes_temp[i]
-
-        for i in categories_size_temp.keys():
-            found = 0
-            for j in self.categories_size.keys():
-                if i == j:
-                    found = 1
-                    self.categories_size[j].update(categories_size_temp[i])
-            if found == 0:
-                self.categories_size[i] = categories_size_temp[i]
-
-        for i in biotypes_size_temp.keys():
-            found = 0
-            for j in self.biotypes_size.keys():
-                if i == j:
-                    found = 1
-                    self.biotypes_size[j].update(biotypes_size_temp[i])
-            if found == 0:
-                self.biotypes_size[i] = biotypes_size_temp[i]
-
-    def print_alfa_charts(self, folder: str, data: dict, kind: str):
+        for kind, matrix, groups in (
+            ("categories", self.categories, self.category_groups),
+            ("biotypes", self.biotypes, self.biotype_groups),
+        ):
+            self.exporter.write(
+                f"multiqc_ALFA_{folder}_{kind}",
+                list(matrix.samples),
+                list(matrix.features),
+                {
+                    "counts": matrix.counts,
+                    "sizes": matrix.sizes,
+                    "counts_percent": matrix.counts_percent,
+                    "sizes_percent": matrix.sizes_percent,
+                    "enrichment": matrix.enrichment,
+                },
+            )
+            if groups is not None:
+                self.exporter.write(
+                    f"multiqc_ALFA_{folder}_{kind}_conditions",
+                    list(groups.groups),
+                    list(groups.features),
+                    {
+                        "mean_counts": groups.mean_counts,
+                        "sd_counts": groups.sd_counts,
+                        "mean_counts_percent": groups.mean_counts_percent,
+                        "sd_counts_percent": groups.sd_counts_percent,
+                        "pooled_enrichment": groups.enrichment,
+                    },
+                    extra={"n_samples": groups.sizes},
+                )
+
+    def print_alfa_charts(self, folder: str, data, kind: str):
         """
-        Takes in dictionary containing parsed data and passes them to MultiQC
-        function to print the graphs.
+        Takes in the matrix containing parsed data, or its summary by
+        condition, and passes its values to MultiQC function to print
+        the graphs.
         """
+        # Deferred until there is a plot, as the plot modules import matplotlib
+        from multiqc.plots import bargraph
+
+        if isinstance(data, FeatureGroups):
+            name = f"{folder}-{kind}-Conditions"
+            counts = data.to_dict(data.mean_counts)
+            description = (
+                f"Mean counts of the samples of each of the {len(data.groups)} "
+                "conditions; the enrichment is that of the pooled counts."
+            )
+        else:
+            name = f"{folder}-{kind}"
+            counts = data.to_dict(data.counts)
+            description = ""
+
+        pconfig = {"id": plot_id("ALFA", name)}
+        counts, _ = self.compactor.bargraph(pconfig["id"], counts)
         self.add_section(
-            name=f"{folder}-{kind}",
+            name=name,
             anchor=f"{kind}",
-            plot=bargraph.plot(data),
+            description=description,
+            plot=bargraph.plot(counts, pconfig=pconfig),
         )
 
-        self.print_alfa_charts_enrichment(folder=folder, kind=kind)
+        self.print_alfa_charts_enrichment(name=name, data=data, kind=kind)
 
-    def print_alfa_charts_enrichment(self, folder: str, kind: str):
+    def print_alfa_charts_enrichment(self, name: str, data, kind: str):
         """
-        Takes in dictionary containing parsed data and passes them to MultiQC
-        function to print the enrichment graphs.
+        Takes in the matrix containing parsed data, or its summary by
+        condition, and passes its enrichments to MultiQC function to print
+        the enrichment graphs.
         """
-        if kind == "Categories":
-            data = self.categories_enrich
-        else:
-            data = self.biotypes_enrich
+        from multiqc.plots import bargraph
 
-        cats = []
-        for i in data.keys():
-            for j in data[i]:
-                cats.append(str(j))
+        cats = list(data.features)
+        data = data.to_dict(data.enrichment)
 
         config = {
             # Building the plot
-            "id": "<random string>",  # HTML ID used for plot
+            "id": plot_id("ALFA", name, "enrichment"),  # HTML ID used for plot
             "cpswitch": False,  # Show the 'Counts / Percentages' switch?
             "cpswitch_c_active": True,
             # Initial display with 'Counts' specified? False for percentages.
@@ -357,101 +362,55 @@ class MultiqcModule(BaseMultiqcModule):
             "tt_percentages": False,
             # Show the percentages of each count in the tooltip
         }
+        # A log2 enrichment of zero is shown
+        data, cats = self.compactor.bargraph(
+            config["id"], data, config["tt_decimals"], cats, drop_zeros=False
+        )
         self.add_section(
-            name=f"{folder}-{kind}-Enrichment",
+            name=f"{name}-Enrichment",
             anchor=f"{kind}",
             plot=bargraph.plot(data, cats, config),
         )
 
-    def calculatePercentage(self):
+    def is_grouped(self):
         """
-        Calculates the percentage of each type, needed for the enrichment graphs.
+        Whether the samples of the current folder are plotted by condition.
         """
-        if "temp" in self.categories_percent:
-            del self.categories_percent["temp"]
-        if "temp" in self.biotypes_percent:
-            del self.biotypes_percent["temp"]
-        if "temp" in self.categories_size_percent:
-            del self.categories_size_percent["temp"]
-        if "temp" in self.biotypes_size_percent:
-            del self.biotypes_size_percent["temp"]
-
-        categories_total = dict()
-        biotypes_total = dict()
-        for i in self.categories.keys():
-            for j in self.categories[i]:
-                categories_total[i] = categories_total.get(i, 0) + self.categories[i][j]
-        for i in self.biotypes.keys():
-            for j in self.biotypes[i]:
-                biotypes_total[i] = biotypes_total.get(i, 0) + self.biotypes[i][j]
-
-        # Divinding by total subiotypes
-        for i in self.categories.keys():
-            self.categories_percent.setdefault(i, {})
-            for j in self.categories[i]:
-                self.categories_percent[i].setdefault(j, 0)
-                self.categories_percent[i][j] = (
-                    self.categories[i][j] / categories_total[i] * 100
-                )
-        for i in self.biotypes.keys():
-            self.biotypes_percent.setdefault(i, {})
-            for j in self.biotypes[i]:
-                self.biotypes_percent[i].setdefault(j, 0)
-                self.biotypes_percent[i][j] = (
-                    self.biotypes[i][j] / biotypes_total[i] * 100
-                )
+        if self.group_samples == "auto":
+            return len(self.categories.samples) > self.group_threshold
+        return bool(self.group_samples)
 
-        categories_size_total = dict()
-        biotypes_size_total = dict()
-        for i in self.categories_size.keys():
-            for j in self.categories_size[i]:
-                categories_size_total[i] = (
-                    categories_size_total.get(i, 0) + self.categories_size[i][j]
-                )
-        for i in self.biotypes_size.keys():
-            for j in self.biotypes_size[i]:
-                biotypes_size_total[i] = (
-                    biotypes_size_total.get(i, 0) + self.biotypes_size[i][j]
-                )
+    def get_condition(self, sample: str):
+        """
+        Extracts the condition of a sample from its name with group_regex.
+        """
+        match = self.group_regex.search(sample)
+        if match is None:
+            return sample
+        return match.group(1) if match.groups() else match.group(0)
 
-        # Divinding by total subiotypes
-        for i in self.categories_size.keys():
-            self.categories_size_percent.setdefault(i, {})
-            for j in self.categories_size[i]:
-                self.categories_size_percent[i].setdefault(j, 0)
-                self.categories_size_percent[i][j] = (
-                    self.categories_size[i][j] / categories_size_total[i] * 100
-                )
-        for i in self.biotypes_size.keys():
-            self.biotypes_size_percent.setdefault(i, {})
-            for j in self.biotypes_size[i]:
-                self.biotypes_size_percent[i].setdefault(j, 0)
-                self.biotypes_size_percent[i][j] = (
-                    self.biotypes_size[i][j] / biotypes_size_total[i] * 100
-                )
+    def calculateGroups(self):
+        """
+        Summarises the categories and biotypes of the samples by condition.
+        """
+        for matrix, attribute in (
+            (self.categories, "category_groups"),
+            (self.biotypes, "biotype_groups"),
+        ):
+            keys = [self.get_condition(sample) for sample in matrix.samples]
+            setattr(self, attribute, FeatureGroups(matrix, keys))
+
+    def calculatePercentage(self):
+        """
+        Calculates the percentage of each type, needed for the enrichment graphs.
+        """
+        self.categories.calculate_percentages()
+        self.biotypes.calculate_percentages()
 
     def calculateEnrichment(self):
         """
         Calculates percentage of nucleotides divided by percentage of genome for
         total enrichment or depletion.
         """
-        if "temp" in self.categories_enrich:
-            del self.categories_enrich["temp"]
-        if "temp" in self.biotypes_enrich:
-            del self.biotypes_enrich["temp"]
-
-        for i in self.categories.keys():
-            self.categories_enrich.setdefault(i, {})
-            for j in self.categories[i]:
-                self.categories_enrich[i].setdefault(j, 0)
-                self.categories_enrich[i][j] = math.log2(
-                    self.categories_percent[i][j] / self.categories_size_percent[i][j]
-                )
-
-        for i in self.biotypes.keys():
-            self.biotypes_enrich.setdefault(i, {})
-            for j in self.biotypes[i]:
-                self.biotypes_enrich[i].setdefault(j, 0)
-                self.biotypes_enrich[i][j] = math.log2(
-                    self.biotypes_percent[i][j] / self.biotypes_size_percent[i][j]
-                )
+        self.categories.calculate_enrichment()
+        self.biotypes.calculate_enrichment()
@@ -0,0 +1,238 @@
+"""
+Columnar storage of the ALFA values of a cohort.
+
+A FeatureMatrix keeps the read counts and the genome sizes of one kind of
+feature (categories or biotypes) as two samples x features arrays sharing
+interned sample and feature indexes. Percentages and enrichments are
+computed as whole-array operations and only turned into nested dictionaries
+for plotting. A FeatureGroups summarises the samples of a FeatureMatrix by
+condition, so that large cohorts are plotted with one bar per condition.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+# Ways of handling a sample which is added to a FeatureMatrix twice
+DUPLICATE_POLICIES = ("first", "replace", "sum", "error")
+
+
+class DuplicateSampleError(ValueError):
+    """
+    Raised when a sample is added twice under the "error" policy.
+    """
+
+
+class FeatureMatrix(object):
+    """
+    Samples x features matrices of ALFA read counts and feature sizes.
+    Cells of features missing from a sample hold NaN.
+    """
+
+    def __init__(self, dtype=np.float64):
+        self.dtype = dtype
+
+        # Interned labels: name -> row / column of the matrices
+        self.samples = dict()
+        self.features = dict()
+
+        # The arrays are over-allocated and grown geometrically, only the
+        # top-left len(samples) x len(features) block is in use
+        self._counts = np.full((0, 0), np.nan, dtype=dtype)
+        self._sizes = np.full((0, 0), np.nan, dtype=dtype)
+
+        self.counts_percent = None
+        self.sizes_percent = None
+        self.enrichment = None
+
+    @property
+    def counts(self):
+        """
+        Read counts of each feature in each sample.
+        """
+        return self._counts[: len(self.samples), : len(self.features)]
+
+    @property
+    def sizes(self):
+        """
+        Genome size of each feature for each sample.
+        """
+        return self._sizes[: len(self.samples), : len(self.features)]
+
+    def _grow(self, nrows: int, ncols: int):
+        """
+        Makes sure the arrays can hold nrows samples and ncols features.
+        """
+        rows, cols = self._counts.shape
+        if nrows <= rows and ncols <= cols:
+            return
+        shape = (
+            rows if nrows <= rows else max(nrows, 2 * rows),
+            cols if ncols <= cols else max(ncols, 2 * cols),
+        )
+        for name in ("_counts", "_sizes"):
+            old = getattr(self, name)
+            new = np.full(shape, np.nan, dtype=self.dtype)
+            new[:rows, :cols] = old
+            setattr(self, name, new)
+
+    def _intern(self, index: dict, labels):
+        """
+        Returns the positions of the labels in the index, adding the labels
+        not seen so far.
+        """
+        return np.array(
+            [index.setdefault(label, len(index)) for label in labels], dtype=np.intp
+        )
+
+    def add(
+        self,
+        sample: str,
+        features: list,
+        counts: np.ndarray,
+        sizes: np.ndarray,
+        on_duplicate: str = "first",
+    ):
+        """
+        Upserts the counts and sizes of the given features for a sample.
+        The sample and features are looked up in the hashed indexes, so a
+        call costs O(features) however many samples are stored. A sample
+        which is already stored is handled according to on_duplicate: keep
+        the values of the "first" file, "replace" them, "sum" the new values
+        into them, or raise a DuplicateSampleError ("error"). Returns True
+        for a duplicate sample.
+        """
+        if on_duplicate not in DUPLICATE_POLICIES:
+            raise ValueError(
+                f"unknown duplicate policy '{on_duplicate}', "
+                f"expected one of {', '.join(DUPLICATE_POLICIES)}"
+            )
+        duplicate = sample in self.samples
+        if duplicate and on_duplicate == "error":
+            raise DuplicateSampleError(f"sample '{sample}' was already loaded")
+        if duplicate and on_duplicate == "first":
+            return duplicate
+
+        row = self._intern(self.samples, [sample])[0]
+        columns = self._intern(self.features, features)
+        self._grow(len(self.samples), len(self.features))
+
+        if duplicate and on_duplicate == "sum":
+            for array, values in ((self._counts, counts), (self._sizes, sizes)):
+                array[row, columns] = np.nan_to_num(array[row, columns]) + values
+        else:
+            if duplicate:
+                self._counts[row] = np.nan
+                self._sizes[row] = np.nan
+            self._counts[row, columns] = counts
+            self._sizes[row, columns] = sizes
+
+        return duplicate
+
+    def calculate_percentages(self):
+        """
+        Calculates the percentage of the counts and sizes of each feature
+        within its sample.
+        """
+        self.counts_percent = _percentages(self.counts)
+        self.sizes_percent = _percentages(self.sizes)
+
+    def calculate_enrichment(self):
+        """
+        Calculates the log2 ratio of the percentage of reads to the
+        percentage of the genome of each feature.
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.enrichment = np.log2(self.counts_percent / self.sizes_percent)
+
+    def to_dict(self, values: np.ndarray):
+        """
+        Builds the {sample: {feature: value}} dictionary expected by
+        MultiQC plots from one of the matrices, leaving out missing and
+        non-finite cells.
+        """
+        return _to_dict(self.samples, self.features, values)
+
+
+class FeatureGroups(object):
+    """
+    Groups x features summaries of the samples of a FeatureMatrix: the
+    mean and standard deviation of the counts and of their percentages
+    within each sample, and the enrichment of the pooled counts and sizes
+    of each group. Missing cells are left out of the means and standard
+    deviations and count as 0 in the pooled values.
+    """
+
+    def __init__(self, matrix: FeatureMatrix, keys: list):
+        # Interned groups in order of first occurrence, and the group of
+        # each sample (row) of the matrix
+        self.groups = dict()
+        self.features = matrix.features
+        inverse = np.array(
+            [self.groups.setdefault(key, len(self.groups)) for key in keys],
+            dtype=np.intp,
+        )
+        self.sizes = np.bincount(inverse, minlength=len(self.groups))
+
+        self.mean_counts, self.sd_counts = _group_mean_sd(matrix.counts, inverse)
+        self.mean_counts_percent, self.sd_counts_percent = _group_mean_sd(
+            matrix.counts_percent, inverse
+        )
+
+        pooled_counts = _percentages(_group_sums(np.nan_to_num(matrix.counts), inverse))
+        pooled_sizes = _percentages(_group_sums(np.nan_to_num(matrix.sizes), inverse))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.enrichment = np.log2(pooled_counts / pooled_sizes)
+
+    def to_dict(self, values: np.ndarray):
+        """
+        Builds the {group: {feature: value}} dictionary expected by
+        MultiQC plots from one of the summaries.
+        """
+        return _to_dict(self.groups, self.features, values)
+
+
+def _to_dict(rows: dict, features: dict, values: np.ndarray):
+    """
+    Builds the {row: {feature: value}} dictionary of a matrix, leaving out
+    missing and non-finite cells.
+    """
+    features = list(features)
+    finite = np.isfinite(values)
+    data = dict()
+    for label, row in rows.items():
+        keep = np.flatnonzero(finite[row])
+        data[label] = dict(zip([features[i] for i in keep], values[row, keep].tolist()))
+    return data
+
+
+def _group_sums(values: np.ndarray, inverse: np.ndarray):
+    """
+    Sums the rows of values of each group, given the group of each row.
+    """
+    order = np.argsort(inverse, kind="stable")
+    starts = np.flatnonzero(np.diff(inverse[order], prepend=-1))
+    return np.add.reduceat(values[order], starts, axis=0)
+
+
+def _group_mean_sd(values: np.ndarray, inverse: np.ndarray):
+    """
+    Mean and sample standard deviation of the finite values of each group
+    and column. The standard deviation of a single value is NaN.
+    """
+    finite = np.isfinite(values)
+    n = _group_sums(finite.astype(np.float64), inverse)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = _group_sums(np.where(finite, values, 0.0), inverse) / n
+        deviations = np.where(finite, values - mean[inverse], 0.0)
+        sd = np.sqrt(_group_sums(deviations**2, inverse) / (n - 1))
+    return mean, sd
+
+
+def _percentages(values: np.ndarray):
+    """
+    Divides each row by its total and multiplies by 100.
+    """
+    totals = np.nansum(values, axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return values / totals * 100
@@ -0,0 +1,311 @@
+"""
+Persistent on-disk cache of parsed files.
+
+Reports are often re-created for a growing results tree in which most files
+did not change since the last run. The parsed result of each file is kept
+in a SQLite database keyed by the file's path and checked against its size,
+modification time and a hash of its contents, so that only new or changed
+files are parsed again. The hash of a parsed file is computed as it is
+read by the parser; files are only read again to hash them when their
+modification time changed. The total size of the cached results is bounded;
+the least recently used entries are evicted first.
+
+The cache is enabled by the "plugin_parse_cache" section of the MultiQC
+config, and can be inspected and invalidated from the command line:
+
+    multiqc-plugins-cache info
+    multiqc-plugins-cache invalidate path/to/results
+    multiqc-plugins-cache clear
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import pickle
+import sqlite3
+import time
+
+from .parsing import content_digest
+
+# Bump when the format of cached results changes, to invalidate old entries
+CACHE_VERSION = 2
+
+DEFAULT_DIRECTORY = os.path.join("~", ".cache", "multiqc-plugins")
+DEFAULT_MAX_SIZE_MB = 1024
+
+# Returned by ParseCache.get() for files without a valid entry, as None
+# can be a parsed result
+MISS = object()
+
+
+class ParseCache(object):
+    """
+    SQLite-backed cache of the parsed results of files, or of tuples of
+    files parsed together. Entries are grouped in namespaces, which have to
+    include any option that changes the parsed result.
+    """
+
+    def __init__(self, directory: str = DEFAULT_DIRECTORY, max_size_mb: float = None):
+        directory = os.path.expanduser(directory)
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "parse_cache.sqlite")
+        self.max_bytes = int(
+            (DEFAULT_MAX_SIZE_MB if max_size_mb is None else max_size_mb) * 1e6
+        )
+        self.hits = 0
+        self.misses = 0
+
+        self.db = sqlite3.connect(self.path, timeout=60)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS entries (
+                namespace TEXT NOT NULL,
+                path TEXT NOT NULL,
+                identity TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                result BLOB NOT NULL,
+                nbytes INTEGER NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY (namespace, path)
+            )""")
+        self.db.commit()
+
+    @classmethod
+    def from_config(cls, cache_config: dict):
+        """
+        Returns the cache set up by the "plugin_parse_cache" section of the
+        MultiQC config, or None if the cache is not enabled.
+        """
+        if cache_config is None or cache_config.get("enabled") is False:
+            return None
+        return cls(
+            cache_config.get("directory", DEFAULT_DIRECTORY),
+            cache_config.get("max_size_mb"),
+        )
+
+    def get(self, namespace: str, item):
+        """
+        Returns the cached result of a file (or tuple of files), or MISS if
+        there is none or the file changed since it was cached. Files whose
+        size and modification time are unchanged are not read; if only
+        the modification time changed, the contents hash decides.
+        """
+        key = _key(namespace)
+        paths = _paths(item)
+        row = self.db.execute(
+            "SELECT identity, digest, result FROM entries "
+            "WHERE namespace = ? AND path = ?",
+            (key, paths),
+        ).fetchone()
+
+        result = MISS
+        if row is not None:
+            try:
+                identity = _identity(item)
+                if row[0] == identity or row[1] == _digest(item):
+                    result = pickle.loads(row[2])
+            except (OSError, pickle.UnpicklingError, AttributeError, EOFError):
+                result = MISS
+
+        if result is MISS:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.db.execute(
+                "UPDATE entries SET accessed = ?, identity = ? "
+                "WHERE namespace = ? AND path = ?",
+                (time.time(), identity, key, paths),
+            )
+        return result
+
+    def put_many(self, namespace: str, entries: list, digests: dict = None):
+        """
+        Stores the (item, result) pairs, then evicts the least recently
+        used entries beyond the size limit and commits. The digests of the
+        files hashed while parsed (see ParseStats) are used as given; the
+        other files are read to hash them.
+        """
+        key = _key(namespace)
+        rows = []
+        for item, result in entries:
+            try:
+                blob = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+                rows.append(
+                    (
+                        key,
+                        _paths(item),
+                        _identity(item),
+                        _digest(item, digests),
+                        blob,
+                        len(blob),
+                        time.time(),
+                    )
+                )
+            except OSError:
+                # The file disappeared since it was parsed
+                continue
+        self.db.executemany(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+        )
+        self.evict()
+        self.db.commit()
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the cached results
+        fit into the size limit.
+        """
+        total = self.db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM entries")
+        excess = total.fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+        evicted = []
+        for namespace, path, nbytes in self.db.execute(
+            "SELECT namespace, path, nbytes FROM entries ORDER BY accessed"
+        ).fetchall():
+            if excess <= 0:
+                break
+            evicted.append((namespace, path))
+            excess -= nbytes
+        self.db.executemany(
+            "DELETE FROM entries WHERE namespace = ? AND path = ?", evicted
+        )
+
+    def invalidate(self, prefix: str = None):
+        """
+        Deletes all entries, or those of the files under the given path.
+        Returns the number of deleted entries.
+        """
+        if prefix is None:
+            deleted = self.db.execute("DELETE FROM entries").rowcount
+        else:
+            prefix = os.path.abspath(prefix)
+            deleted = self.db.execute(
+                "DELETE FROM entries WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+                (prefix, _like_prefix(prefix)),
+            ).rowcount
+        self.db.commit()
+        return deleted
+
+    def info(self):
+        """
+        Returns the number of entries and the size of the cached results.
+        """
+        return self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM entries"
+        ).fetchone()
+
+    def summary(self):
+        """
+        Returns a one-line summary of the cache hits and misses.
+        """
+        return f"parse cache: {self.hits} hits, {self.misses} misses"
+
+    def close(self):
+        """
+        Commits pending updates and closes the database.
+        """
+        self.db.commit()
+        self.db.close()
+
+
+def _key(namespace: str):
+    """
+    Namespace of the entries, including the version of the cache format.
+    """
+    return f"v{CACHE_VERSION}:{namespace}"
+
+
+def _files(item):
+    """
+    The file dictionaries making up a cached item.
+    """
+    return item if isinstance(item, (tuple, list)) else (item,)
+
+
+def _paths(item):
+    """
+    Absolute paths of the files of an item, as the key of its entry.
+    """
+    return "\n".join(
+        os.path.abspath(os.path.join(f["root"], f["fn"])) for f in _files(item)
+    )
+
+
+def _identity(item):
+    """
+    Size and modification time of the files of an item.
+    """
+    stats = (os.stat(os.path.join(f["root"], f["fn"])) for f in _files(item))
+    return ";".join(f"{st.st_size}:{st.st_mtime_ns}" for st in stats)
+
+
+def _digest(item, digests: dict = None):
+    """
+    Hash of the digests of the contents of the files of an item. Files
+    without a digest in digests (by path) are read to hash them.
+    """
+    digest = content_digest()
+    for f in _files(item):
+        path = os.path.join(f["root"], f["fn"])
+        file_digest = (digests or {}).get(path)
+        if file_digest is None:
+            file_digest = _file_digest(path)
+        digest.update(file_digest.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _file_digest(path: str):
+    """
+    Hash of the contents of a file, as computed by the parsers.
+    """
+    digest = content_digest()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _like_prefix(prefix: str):
+    """
+    SQL LIKE pattern matching the paths below a directory.
+    """
+    escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped.rstrip(os.sep) + os.sep + "%"
+
+
+def main(argv: list = None):
+    """
+    Command line interface to inspect and invalidate the parse cache.
+    """
+    parser = argparse.ArgumentParser(
+        prog="multiqc-plugins-cache",
+        description="Inspect or invalidate the parse cache of the MultiQC plugins.",
+    )
+    parser.add_argument(
+        "--directory",
+        default=DEFAULT_DIRECTORY,
+        help=f"cache directory (default: {DEFAULT_DIRECTORY})",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("info", help="show the number and size of cached entries")
+    commands.add_parser("clear", help="delete all cached entries")
+    invalidate = commands.add_parser(
+        "invalidate", help="delete the cached entries of files under the paths"
+    )
+    invalidate.add_argument("paths", nargs="+")
+    args = parser.parse_args(argv)
+
+    cache = ParseCache(args.directory)
+    if args.command == "info":
+        entries, nbytes = cache.info()
+        print(f"{cache.path}: {entries} entries, {nbytes / 1e6:.2f} MB")
+    elif args.command == "clear":
+        print(f"Deleted {cache.invalidate()} entries")
+    else:
+        deleted = sum(cache.invalidate(path) for path in args.paths)
+        print(f"Deleted {deleted} entries")
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+Compaction of the plot data of the plugin modules.
+
+MultiQC embeds the data of every plot in the report as JSON, and for large
+cohorts it makes up most of the report. Before plotting, a PlotCompactor
+shrinks the data of a plot without changing what is displayed:
+
+- values are rounded to the decimals shown in the tooltips, keeping at
+  least a few significant digits so that small values are still placed
+  correctly on the axes
+- categories (bar graphs) and points (line graphs) that are zero or
+  missing in every sample are left out
+- the colour shared by most points of a scatter plot is set once as the
+  marker colour of the plot instead of on every point
+
+The size of the compacted data of each plot is logged. With "measure" set
+(by default when MultiQC runs verbose), the data is also serialised before
+compaction to log the bytes saved. plot_id() gives the plots stable HTML
+IDs, which also lets users target them in "custom_plot_config".
+
+The compaction is set up by the "plugin_compaction" section of the MultiQC
+config.
+"""
+
+from __future__ import print_function
+from collections import Counter
+import json
+import logging
+import re
+
+import numpy as np
+
+log = logging.getLogger(f"multiqc.{__name__}")
+
+
+def plot_id(*parts: str):
+    """
+    Builds a stable HTML ID for a plot from the names identifying it, such
+    as the module, the folder and the kind of plot.
+    """
+    return re.sub(r"[^a-z0-9_-]+", "_", "_".join(parts).lower()).strip("_")
+
+
+def round_values(values: np.ndarray, decimals: int, digits: int):
+    """
+    Rounds each value to the given number of decimals, or to more
+    decimals if needed to keep digits significant digits.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        magnitude = np.floor(np.log10(np.abs(values)))
+    places = np.where(np.isfinite(magnitude), digits - 1 - magnitude, decimals)
+    # Powers of ten up to 1e22 are exact doubles
+    scale = 10.0 ** np.clip(places, decimals, 22)
+    with np.errstate(invalid="ignore"):
+        return np.round(values * scale) / scale
+
+
+class PlotCompactor(object):
+    """
+    Compacts the data of the plots of a module before they are plotted.
+    A disabled compactor returns the data unchanged. The size of the data
+    before compaction is only measured if measure is set, as it serialises
+    the larger, uncompacted data of every plot.
+    """
+
+    def __init__(self, enabled: bool = True, digits: int = 4, measure: bool = False):
+        self.enabled = enabled
+        self.digits = digits
+        self.measure = measure
+        # (plot, bytes before, bytes after) of each compacted plot, with
+        # bytes before of None if not measured
+        self.plots = []
+
+    @classmethod
+    def from_config(cls, compaction_config: dict):
+        """
+        Returns the compactor set up by the "plugin_compaction" section of
+        the MultiQC config. Unless "measure" is set, the sizes before
+        compaction are measured if MultiQC runs verbose.
+        """
+        compaction_config = compaction_config or {}
+        return cls(
+            enabled=compaction_config.get("enabled", True),
+            digits=compaction_config.get("digits", 4),
+            measure=compaction_config.get("measure", _verbose()),
+        )
+
+    def bargraph(
+        self,
+        name: str,
+        data: dict,
+        decimals: int = 0,
+        cats: list = None,
+        drop_zeros: bool = True,
+    ):
+        """
+        Compacts the {sample: {category: value}} data of a bar graph with
+        the given tooltip decimals. Categories missing in every sample, or
+        zero in every sample if drop_zeros is set, are left out, and from
+        cats if given. Returns the data and the categories.
+        """
+        if not self.enabled:
+            return data, cats
+        before = self._size(data)
+        data = self._round_nested(data, decimals)
+        kept = {
+            key
+            for values in data.values()
+            for key, v in values.items()
+            if v or not drop_zeros
+        }
+        data = {
+            sample: {key: v for key, v in values.items() if key in kept}
+            for sample, values in data.items()
+        }
+        if cats is not None:
+            cats = [cat for cat in cats if cat in kept]
+        self._record(name, before, data)
+        return data, cats
+
+    def linegraph(self, name: str, data: dict, decimals: int = 0):
+        """
+        Compacts the {sample: {x: y}} data of a line graph with the given
+        tooltip decimals. Points at an x where y is zero in every sample
+        are left out.
+        """
+        if not self.enabled:
+            return data
+        before = self._size(data)
+        data = self._round_nested(data, decimals)
+        kept = {x for points in data.values() for x, y in points.items() if y}
+        data = {
+            sample: {x: y for x, y in points.items() if x in kept}
+            for sample, points in data.items()
+        }
+        self._record(name, before, data)
+        return data
+
+    def heatmap(self, name: str, rows: np.ndarray, decimals: int = 2):
+        """
+        Compacts the rows x columns values of a heatmap with the given
+        tooltip decimals and returns them as a list of lists.
+        """
+        if not self.enabled:
+            return np.asarray(rows).tolist()
+        rounded = round_values(rows, decimals, self.digits).tolist()
+        before = _size(np.asarray(rows).tolist()) if self.measure else None
+        self._record(name, before, rounded)
+        return rounded
+
+    def scatter(self, name: str, data: dict, pconfig: dict, decimals: int = 2):
+        """
+        Compacts the {sample: point} data of a scatter plot with the given
+        tooltip decimals. The most common point colour becomes the marker
+        colour of the plot, set in pconfig, unless pconfig sets one.
+        """
+        if not self.enabled:
+            return data
+        before = self._size(data)
+        samples = list(data)
+        points = [data[sample] for sample in samples]
+        coordinates = round_values(
+            [[p["x"], p["y"]] for p in points], decimals, self.digits
+        ).tolist()
+
+        colors = Counter(p.get("color") for p in points)
+        colors.pop(None, None)
+        shared = None
+        if colors and "marker_colour" not in pconfig:
+            shared, count = colors.most_common(1)[0]
+            if count > 1:
+                pconfig["marker_colour"] = shared
+            else:
+                shared = None
+
+        compacted = dict()
+        for sample, point, (x, y) in zip(samples, points, coordinates):
+            compacted[sample] = {
+                key: value
+                for key, value in point.items()
+                if not (key == "color" and value == shared)
+            }
+            compacted[sample].update(x=x, y=y)
+        self._record(name, before, compacted)
+        return compacted
+
+    def summary(self):
+        """
+        Returns a one-line summary of the size of the compacted plot data,
+        and of the bytes saved if measured.
+        """
+        after = sum(sizes[2] for sizes in self.plots)
+        if not self.measure:
+            return (
+                f"compacted the data of {len(self.plots)} plots to "
+                f"{after / 1e6:.2f} MB"
+            )
+        before = sum(sizes[1] for sizes in self.plots)
+        return (
+            f"compacted the data of {len(self.plots)} plots from "
+            f"{before / 1e6:.2f} MB to {after / 1e6:.2f} MB "
+            f"({(before - after) / max(before, 1):.0%} saved)"
+        )
+
+    def _round_nested(self, data: dict, decimals: int):
+        """
+        Rounds the values of a {sample: {key: value}} dictionary in one
+        vectorised pass.
+        """
+        values = [v for inner in data.values() for v in inner.values()]
+        rounded = round_values(values, decimals, self.digits).tolist()
+        # Integers are already as short as they get
+        rounded = iter(v if isinstance(v, int) else r for v, r in zip(values, rounded))
+        return {
+            sample: {key: next(rounded) for key in inner}
+            for sample, inner in data.items()
+        }
+
+    def _size(self, data):
+        """
+        Size of the uncompacted data of a plot, or None if not measured.
+        """
+        return _size(data) if self.measure else None
+
+    def _record(self, name: str, before: int, data):
+        """
+        Records and logs the size of the data of a compacted plot, and of
+        its data before compaction if measured.
+        """
+        after = _size(data)
+        self.plots.append((name, before, after))
+        if before is None:
+            log.debug(f"{name}: plot data compacted to {after} bytes")
+        else:
+            log.debug(f"{name}: plot data compacted from {before} to {after} bytes")
+
+
+def _verbose():
+    """
+    Whether MultiQC prints debug messages on the console, as with --verbose.
+    Its log file always gets them, so the level of the logger is no guide.
+    """
+    handlers = logging.getLogger("multiqc").handlers
+    return any(
+        type(handler) is logging.StreamHandler and handler.level <= logging.DEBUG
+        for handler in handlers
+    )
+
+
+def _size(data):
+    """
+    Number of bytes of the data serialised as JSON, as in the report.
+    """
+    return len(json.dumps(data))
@@ -0,0 +1,257 @@
+"""
+Columnar export of the parsed data of the plugin modules.
+
+The values behind the plots end up in MultiQC's data files as nested
+{sample: {feature: value}} dictionaries, which are large and slow to load for
+big cohorts. Each module therefore also writes its samples x features
+matrices (the ALFA counts, percentages and enrichments, the TIN score
+histograms, the PCA coordinates) to the MultiQC data directory in a binary
+columnar format, with the sample and column labels that index them:
+
+    npz      NumPy archive: one array per matrix, "samples" and the column
+             labels, readable with numpy.load() alone
+    arrow    Arrow IPC file, memory-mapped when read
+    parquet  Parquet file
+
+Arrow and Parquet tables have a "sample" column followed by one column per
+matrix and label, named "<matrix>/<label>", and need pyarrow; without it the
+matrices are written as npz. read_export() loads any of them back.
+
+The export is set up by the "plugin_export" section of the MultiQC config.
+"""
+
+from __future__ import print_function
+import json
+import logging
+import os
+
+import numpy as np
+
+log = logging.getLogger(f"multiqc.{__name__}")
+
+# File extension of each export format
+FORMATS = {"npz": ".npz", "arrow": ".arrow", "parquet": ".parquet"}
+
+# Key of the layout of an export in npz archives and Arrow/Parquet metadata
+LAYOUT_KEY = "multiqc_plugins_layout"
+
+
+class Exporter(object):
+    """
+    Writes the matrices of a module to a directory. A disabled exporter,
+    or one without a directory, writes nothing.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        enabled: bool = True,
+        format: str = "npz",
+        compress: bool = False,
+    ):
+        if format not in FORMATS:
+            raise ValueError(
+                f"unknown export format '{format}', "
+                f"expected one of {', '.join(FORMATS)}"
+            )
+        self.directory = directory
+        self.enabled = enabled and directory is not None
+        self.format = format
+        self.compress = compress
+        self.written = []
+
+        if self.enabled and format != "npz" and not _has_pyarrow():
+            log.warning(f"pyarrow is not installed, exporting npz instead of {format}")
+            self.format = "npz"
+
+    @classmethod
+    def from_config(cls, export_config: dict, directory: str):
+        """
+        Returns the exporter set up by the "plugin_export" section of the
+        MultiQC config, writing to the given data directory.
+        """
+        export_config = export_config or {}
+        return cls(
+            directory,
+            enabled=export_config.get("enabled", True),
+            format=export_config.get("format", "npz"),
+            compress=export_config.get("compress", False),
+        )
+
+    def write(
+        self,
+        fn: str,
+        samples: list,
+        columns: list,
+        matrices: dict,
+        columns_name: str = "features",
+        extra: dict = None,
+    ):
+        """
+        Writes the {name: samples x columns array} matrices, labelled by
+        the samples and columns, to "<fn>.<format>" and returns its path.
+        Extra arrays (of any shape) are stored alongside them. A file name
+        used before in the run gets a numbered suffix.
+        """
+        if not self.enabled:
+            return None
+
+        path = os.path.join(self.directory, fn + FORMATS[self.format])
+        i = 1
+        while path in self.written or os.path.exists(path):
+            path = os.path.join(self.directory, f"{fn}_{i}{FORMATS[self.format]}")
+            i += 1
+
+        samples = np.asarray(samples, dtype=str)
+        columns = np.asarray(columns)
+        extra = {key: np.asarray(value) for key, value in (extra or {}).items()}
+        reserved = {"samples", columns_name, LAYOUT_KEY}
+        if reserved & (set(matrices) | set(extra)):
+            raise ValueError(
+                f"matrix and extra array names cannot be one of {sorted(reserved)}"
+            )
+        for name, values in matrices.items():
+            if values.shape != (len(samples), len(columns)):
+                raise ValueError(
+                    f"matrix '{name}' has shape {values.shape}, expected "
+                    f"{(len(samples), len(columns))}"
+                )
+        layout = {
+            "columns_name": columns_name,
+            "matrices": list(matrices),
+            "extra": list(extra),
+        }
+
+        if self.format == "npz":
+            _write_npz(path, samples, columns, matrices, extra, layout, self.compress)
+        else:
+            _write_arrow(path, samples, columns, matrices, extra, layout, self.format)
+        self.written.append(path)
+        return path
+
+    def summary(self):
+        """
+        Returns a one-line summary of the exported files.
+        """
+        nbytes = sum(os.path.getsize(path) for path in self.written)
+        return (
+            f"exported {len(self.written)} {self.format} files, "
+            f"{nbytes / 1e6:.2f} MB"
+        )
+
+
+def _has_pyarrow():
+    """
+    Whether pyarrow, needed for the Arrow and Parquet formats, is installed.
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _write_npz(
+    path: str,
+    samples: np.ndarray,
+    columns: np.ndarray,
+    matrices: dict,
+    extra: dict,
+    layout: dict,
+    compress: bool,
+):
+    """
+    Writes the matrices as arrays of a NumPy archive.
+    """
+    arrays = dict(extra)
+    arrays.update(matrices)
+    arrays["samples"] = samples
+    arrays[layout["columns_name"]] = columns
+    arrays[LAYOUT_KEY] = np.array(json.dumps(layout))
+    save = np.savez_compressed if compress else np.savez
+    with open(path, "wb") as fh:
+        save(fh, **arrays)
+
+
+def _write_arrow(
+    path: str,
+    samples: np.ndarray,
+    columns: np.ndarray,
+    matrices: dict,
+    extra: dict,
+    layout: dict,
+    format: str,
+):
+    """
+    Writes the matrices as a wide Arrow IPC or Parquet table with one row
+    per sample. The column labels and the extra arrays are kept in the
+    metadata of the table.
+    """
+    import pyarrow as pa
+
+    names = ["sample"]
+    arrays = [pa.array(samples.tolist(), type=pa.string())]
+    for name, values in matrices.items():
+        for j, label in enumerate(columns.tolist()):
+            names.append(f"{name}/{label}")
+            arrays.append(pa.array(np.ascontiguousarray(values[:, j])))
+
+    layout = dict(
+        layout,
+        columns=columns.tolist(),
+        extra={key: value.tolist() for key, value in extra.items()},
+    )
+    table = pa.Table.from_arrays(
+        arrays, names=names, metadata={LAYOUT_KEY: json.dumps(layout)}
+    )
+    if format == "parquet":
+        import pyarrow.parquet as pq
+
+        pq.write_table(table, path)
+    else:
+        with pa.OSFile(path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+
+def read_export(path: str):
+    """
+    Reads an exported file and returns its samples, its column labels, the
+    {name: samples x columns array} matrices and the extra arrays.
+    """
+    if path.endswith(FORMATS["npz"]):
+        with np.load(path) as archive:
+            layout = json.loads(str(archive[LAYOUT_KEY]))
+            return (
+                archive["samples"],
+                archive[layout["columns_name"]],
+                {name: archive[name] for name in layout["matrices"]},
+                {key: archive[key] for key in layout["extra"]},
+            )
+
+    import pyarrow as pa
+
+    if path.endswith(FORMATS["parquet"]):
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path)
+    else:
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    layout = json.loads(table.schema.metadata[LAYOUT_KEY.encode()])
+    columns = layout["columns"]
+    matrices = {
+        name: (
+            np.column_stack(
+                [table.column(f"{name}/{label}").to_numpy() for label in columns]
+            )
+            if columns
+            else np.empty((table.num_rows, 0))
+        )
+        for name in layout["matrices"]
+    }
+    return (
+        np.asarray(table.column("sample").to_pylist(), dtype=str),
+        np.asarray(columns),
+        matrices,
+        {key: np.asarray(value) for key, value in layout["extra"].items()},
+    )
@@ -1,4 +1,150 @@
-from multiqc.utils import config
+import fnmatch
+import os
+
+from multiqc.utils import config, report
+
+# File names searched for by the search patterns of each plugin module
+FILE_NAMES = {
+    "ALFA": {"ALFA": "*ALFA_feature_counts.tsv"},
+    "tin-score": {
+        "tin-score": "TIN_score.tsv",
+        "tin-score/merged": "TIN_scores_merged.tsv",
+    },
+    "zpca": {
+        "zpca/pca": "PCA.tsv",
+        "zpca/scree": "scree.tsv",
+        "zpca/counts": "*counts_matrix.tsv",
+    },
+}
+
+# Search keys registered only when the module option (section and key of the
+# MultiQC config) enabling them is set
+OPT_IN_KEYS = {"zpca/counts": ("zpca_config", "counts_pca")}
+
+# Search keys of the plugin modules, and the extensions of the compressed
+# files they match: those of parsing.DECOMPRESSORS, not imported by the hook,
+# which MultiQC loads on every run, as the parsing layer imports NumPy
+SEARCH_KEYS = {sp_key for names in FILE_NAMES.values() for sp_key in names}
+COMPRESSED_EXTENSIONS = (".gz", ".bz2", ".xz")
+
+# Search rules, overridden under "plugin_search" in the MultiQC config:
+# directories that are not walked into (tool caches and temporary alignment
+# directories; MultiQC walks the tree once for all modules, so this applies
+# to every module of the run) and the maximum size in MB of the files of
+# each search pattern (None for no limit), in place of MultiQC's
+# log_filesize_limit
+SEARCH_DEFAULTS = {
+    "ignore_dirs": [".git", ".snakemake", "_STARtmp"],
+    "max_filesize_mb": {
+        "ALFA": 10,
+        "tin-score": 100,
+        "tin-score/merged": None,
+        "zpca/pca": None,
+        "zpca/scree": 1,
+        "zpca/counts": None,
+    },
+}
+
+
+def patterns(fn: str, max_filesize_mb: float = None):
+    """
+    Search patterns matching a file name, plain or compressed with any of
+    the supported compressions unless "plugin_compressed_inputs" is false,
+    and not larger than max_filesize_mb.
+    """
+    names = [fn]
+    if getattr(config, "plugin_compressed_inputs", True):
+        names += [fn + ext for ext in COMPRESSED_EXTENSIONS]
+
+    sps = [{"fn": name} for name in names]
+    if max_filesize_mb is not None:
+        for sp in sps:
+            sp["max_filesize"] = int(max_filesize_mb * 1e6)
+    return sps
+
+
+def search_plugins(search_file, filesize_limit: float):
+    """
+    Wraps MultiQC's search_file() for the search patterns of the plugin
+    modules:
+
+    - MultiQC skips every file larger than its log_filesize_limit before
+      any pattern sees it. The hook raises that limit to the largest size
+      limit of the plugin patterns, so the wrapper applies the original
+      filesize_limit to the search keys not in sized_keys: those of every
+      other module, and plugin keys whose patterns the hook did not set.
+    - MultiQC skips the files that have a compression encoding as long as
+      it ignores images, so the compressed files of the plugin search keys
+      are matched here by name and size, as MultiQC would.
+
+    The search of every other module, and its config, are left unchanged.
+    """
+
+    def search(pattern, f, module_key):
+        if module_key not in search.sized_keys:
+            if f.get("filesize", 0) > search.filesize_limit:
+                return False
+        compressed = os.path.splitext(f["fn"])[1] in COMPRESSED_EXTENSIONS
+        if compressed and module_key in SEARCH_KEYS and match_name(pattern, f):
+            return True
+        return search_file(pattern, f, module_key)
+
+    search.plugin_search = True
+    search.filesize_limit = filesize_limit
+    search.sized_keys = set()
+    return search
+
+
+def match_name(pattern: dict, f: dict):
+    """
+    Returns whether a file matches a search pattern made of a file name and
+    size limit only, like those of patterns().
+    """
+    if set(pattern) - {"fn", "max_filesize", "shared"} or "fn" not in pattern:
+        return False
+    if pattern.get("max_filesize") is not None:
+        if f.get("filesize", 0) > pattern["max_filesize"]:
+            return False
+    return fnmatch.fnmatch(f["fn"], pattern["fn"])
+
+
+def search_rules():
+    """
+    Returns the search rules with the "plugin_search" config applied.
+    """
+    search_config = getattr(config, "plugin_search", {})
+    return {
+        "ignore_dirs": search_config.get("ignore_dirs", SEARCH_DEFAULTS["ignore_dirs"]),
+        "max_filesize_mb": dict(
+            SEARCH_DEFAULTS["max_filesize_mb"],
+            **search_config.get("max_filesize_mb", {}),
+        ),
+    }
+
+
+def opted_in(sp_key: str):
+    """
+    Returns whether the search pattern of a search key is registered: always,
+    unless the key is opt-in and its module option is not set.
+    """
+    if sp_key not in OPT_IN_KEYS:
+        return True
+    section, option = OPT_IN_KEYS[sp_key]
+    return bool(getattr(config, section, {}).get(option, False))
+
+
+def selected_modules():
+    """
+    Returns the plugin modules of the run: those given with --module, or
+    all of them if no module is given, less those given with --exclude.
+    """
+    run_modules = getattr(config, "run_modules", None) or FILE_NAMES
+    exclude_modules = getattr(config, "exclude_modules", None) or ()
+    return [
+        module
+        for module in FILE_NAMES
+        if module in run_modules and module not in exclude_modules
+    ]
 
 
 def execution_start():
@@ -8,12 +154,35 @@ def execution_start():
     to use custom command line flags.
     """
 
-    # Add to the search patterns used by modules
-    if "ALFA" not in config.sp:
-        config.update_dict(config.sp, {"ALFA": {"fn": "*ALFA_feature_counts.tsv"}})
-    if "tin-score" not in config.sp:
-        config.update_dict(config.sp, {"tin-score": {"fn": "TIN_score.tsv"}})
-    if "zpca/pca" not in config.sp:
-        config.update_dict(config.sp, {"zpca/pca": {"fn": "PCA.tsv"}})
-    if "zpca/scree" not in config.sp:
-        config.update_dict(config.sp, {"zpca/scree": {"fn": "scree.tsv"}})
+    # Nothing to set up if none of the plugin modules runs
+    modules = selected_modules()
+    if not modules:
+        return
+
+    # Prune the directories that never hold plugin files from the file search
+    rules = search_rules()
+    for pattern in rules["ignore_dirs"]:
+        if pattern not in config.fn_ignore_dirs:
+            config.fn_ignore_dirs.append(pattern)
+
+    # Add the search patterns of the modules that run, less the opt-in ones
+    # that are not enabled
+    sized = dict()
+    for module in modules:
+        for sp_key, fn in FILE_NAMES[module].items():
+            if sp_key not in config.sp and opted_in(sp_key):
+                sized[sp_key] = rules["max_filesize_mb"][sp_key]
+                config.update_dict(config.sp, {sp_key: patterns(fn, sized[sp_key])})
+
+    # MultiQC skips the files over log_filesize_limit (10 MB by default) for
+    # all modules, and the compressed files while it ignores images. The
+    # limit is raised to let the large plugin files through, and the wrapped
+    # search keeps the original limit for the other modules
+    search = report.search_file
+    if not getattr(search, "plugin_search", False):
+        search = report.search_file = search_plugins(search, config.log_filesize_limit)
+    search.sized_keys = set(sized)
+    config.log_filesize_limit = max(
+        [search.filesize_limit]
+        + [float("inf") if mb is None else mb * 1e6 for mb in sized.values()]
+    )
@@ -0,0 +1,105 @@
+"""
+Optional parallel parsing of the files found by the plugin modules.
+
+The files of a module are parsed independently of each other, so they can
+be fanned out to a pool of worker processes. parse_files() returns the
+results in the order of the files, whatever the number of workers, so that
+the modules reduce them into their cohort stores deterministically. Files
+with a valid entry in the parse cache are not parsed at all. When parsed
+serially, the files can be read ahead by a Prefetcher.
+"""
+
+from __future__ import print_function
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import os
+
+from .cache import MISS, ParseCache
+from .parsing import ParseStats
+from .prefetch import Prefetcher
+
+
+def parse_workers(module_config: dict):
+    """
+    Returns the number of parse worker processes set by the "parse_workers"
+    option of a module: 1 (the default) parses serially, "auto" uses one
+    worker per CPU.
+    """
+    workers = module_config.get("parse_workers", 1)
+    if workers == "auto":
+        return os.cpu_count() or 1
+    return max(int(workers), 1)
+
+
+def parse_files(
+    parse,
+    files: list,
+    workers: int = 1,
+    stats: ParseStats = None,
+    cache: ParseCache = None,
+    namespace: str = None,
+    prefetcher: Prefetcher = None,
+):
+    """
+    Calls parse(f, stats) for each file and returns the results in the
+    order of the files. With more than one worker the files are parsed in
+    a process pool; parse then has to be a module-level function (or a
+    functools.partial of one) and the files picklable, and the statistics
+    of the workers are added to stats. Otherwise the prefetcher, if given,
+    reads the next files while one is parsed. With a cache, the results of
+    unchanged files are taken from it under the given namespace and the
+    others are stored in it, hashed as they are parsed.
+    """
+    results = [MISS] * len(files)
+    if cache is not None:
+        results = [cache.get(namespace, f) for f in files]
+        if stats is None:
+            stats = ParseStats()
+        if stats.digests is None:
+            stats.digests = dict()
+    todo = [k for k, result in enumerate(results) if result is MISS]
+
+    parsed = _parse_all(parse, [files[k] for k in todo], workers, stats, prefetcher)
+    for k, result in zip(todo, parsed):
+        results[k] = result
+
+    if cache is not None:
+        cache.put_many(namespace, [(files[k], results[k]) for k in todo], stats.digests)
+    return results
+
+
+def _parse_all(
+    parse, files: list, workers: int, stats: ParseStats, prefetcher: Prefetcher
+):
+    """
+    Parses the files serially or in a process pool.
+    """
+    if workers <= 1 or len(files) < 2:
+        if prefetcher is not None:
+            files = prefetcher.iter(files)
+        return [parse(f, stats) for f in files]
+
+    # Batches of files amortise the inter-process round trips
+    chunksize = max(1, len(files) // (4 * workers))
+    results = []
+    with ProcessPoolExecutor(max_workers=min(workers, len(files))) as pool:
+        for result, worker_stats in pool.map(
+            _parse_with_stats,
+            repeat(parse),
+            files,
+            repeat(stats is not None and stats.digests is not None),
+            chunksize=chunksize,
+        ):
+            results.append(result)
+            if stats is not None:
+                stats.merge(worker_stats)
+    return results
+
+
+def _parse_with_stats(parse, f, digests: bool = False):
+    """
+    Parses a file in a worker process and returns the result with the
+    parse statistics (and digests) of that file.
+    """
+    stats = ParseStats(digests)
+    return parse(f, stats), stats
@@ -0,0 +1,536 @@
+"""
+Shared parsing layer for the plugin modules.
+
+The TSV files handled by the ALFA, tin-score and zpca modules are small,
+regular tables: a header line followed by rows holding one label column and
+one or more numeric columns. iter_tsv() streams such a table from its lines,
+one chunk of rows at a time: each chunk is split in a single pass and each
+column converted to a NumPy array, following a column schema declared by
+the calling module. read_log() and iter_log() parse the files found by
+MultiQC this way. Files compressed with gzip, bzip2 or xz are decompressed
+while they are streamed.
+
+Large uncompressed files are not decoded to text at all: iter_log() maps
+them in memory and iter_buffer() parses them from bytes, a chunk of lines
+at a time. The label column is the only one decoded; the numeric columns
+are converted from the bytes of the chunk by NumPy's C parser, so that
+neither the text of the file nor a string per field is created.
+"""
+
+from __future__ import print_function
+from collections import namedtuple
+from contextlib import contextmanager
+import bz2
+import gzip
+import hashlib
+import io
+import lzma
+import mmap
+import os
+import time
+
+import numpy as np
+
+# A column of a TSV file: the expected header name (None accepts any name)
+# and the dtype the column is converted to.
+Column = namedtuple("Column", ["name", "dtype"])
+
+# Number of rows converted at once when streaming a file with iter_tsv(),
+# fewer for wide files so that a chunk holds at most CHUNK_CELLS fields
+CHUNK_ROWS = 65536
+CHUNK_CELLS = 1 << 21
+
+# Functions opening the files with these extensions as decompressed streams
+DECOMPRESSORS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+# Maximum number of bytes read from the start of a file to check its header
+SNIFF_BYTES = 4096
+
+# Uncompressed files of at least MAP_BYTES are parsed from a memory map by
+# iter_log(), MAP_CHUNK_BYTES of lines at a time, and not prefetched
+MAP_BYTES = 1 << 24
+MAP_CHUNK_BYTES = 1 << 20
+
+# Whether the parsed pages of a memory map can be released: madvise() needs
+# Python 3.8, and without it the whole file would end up in memory, so
+# files are then streamed as text instead
+MAP_RELEASE = hasattr(mmap.mmap, "madvise") and hasattr(mmap, "MADV_DONTNEED")
+
+
+class Schema(object):
+    """
+    Describes the layout of a TSV file: the leading columns which have to be
+    present and the dtype of any further columns (None if no further columns
+    are allowed).
+    """
+
+    def __init__(self, columns: list, rest=None):
+        self.columns = list(columns)
+        self.rest = rest
+
+    def dtypes(self, header: list):
+        """
+        Validates a header line against the schema and returns the dtype of
+        each of its columns.
+        """
+        if len(header) < len(self.columns):
+            raise ValueError(
+                f"expected at least {len(self.columns)} columns, "
+                f"found {len(header)}"
+            )
+        for column, name in zip(self.columns, header):
+            if column.name is not None and column.name != name:
+                raise ValueError(f"expected column '{column.name}', found '{name}'")
+        extra = len(header) - len(self.columns)
+        if extra and self.rest is None:
+            raise ValueError(
+                f"expected {len(self.columns)} columns, found {len(header)}"
+            )
+        return [column.dtype for column in self.columns] + [self.rest] * extra
+
+
+class Table(object):
+    """
+    Parsed TSV file: the header line and one NumPy array per column.
+    """
+
+    def __init__(self, header: list, columns: list):
+        self.header = header
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __getitem__(self, index: int):
+        return self.columns[index]
+
+
+class ParseStats(object):
+    """
+    Accumulates the number of files, rows and bytes parsed by a module and
+    the time spent on it, to report the parse throughput. With digests set,
+    the files read from their path are also hashed as they are parsed, for
+    the parse cache, and the digests kept by path.
+    """
+
+    def __init__(self, digests: bool = False):
+        self.files = 0
+        self.rows = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.digests = dict() if digests else None
+
+    def add(self, rows: int, nbytes: int, seconds: float):
+        """
+        Records one parsed file.
+        """
+        self.files += 1
+        self.rows += rows
+        self.bytes += nbytes
+        self.seconds += seconds
+
+    def merge(self, other: "ParseStats"):
+        """
+        Adds the statistics accumulated by another ParseStats, e.g. in a
+        worker process.
+        """
+        self.files += other.files
+        self.rows += other.rows
+        self.bytes += other.bytes
+        self.seconds += other.seconds
+        if self.digests is not None and other.digests:
+            self.digests.update(other.digests)
+
+    def summary(self):
+        """
+        Returns a one-line, human readable throughput summary.
+        """
+        seconds = max(self.seconds, 1e-9)
+        return (
+            f"parsed {self.files} files, {self.rows} rows, "
+            f"{self.bytes / 1e6:.2f} MB in {self.seconds:.3f}s "
+            f"({self.rows / seconds:,.0f} rows/s, "
+            f"{self.bytes / 1e6 / seconds:.1f} MB/s)"
+        )
+
+
+def iter_tsv(
+    stream,
+    schema: Schema,
+    chunk_rows: int = CHUNK_ROWS,
+    stats: ParseStats = None,
+    sep: str = "\t",
+):
+    """
+    Streams a TSV file with a header line from an iterable of lines, such
+    as an open file or an io.StringIO, and yields its body as Tables of at
+    most chunk_rows rows, and of at most CHUNK_CELLS fields. Only one chunk
+    of lines is held in memory at a time. Blank lines are ignored and an
+    empty stream yields nothing.
+    """
+    seconds, nbytes, nrows = 0.0, 0, 0
+    header = dtypes = None
+    stream = iter(stream)
+
+    while True:
+        start = time.perf_counter()
+        lines = []
+        for line in stream:
+            nbytes += len(line)
+            line = line.rstrip("\r\n")
+            if not line:
+                continue
+            if header is None:
+                header = line.split(sep)
+                dtypes = schema.dtypes(header)
+                chunk_rows = min(chunk_rows, max(1, CHUNK_CELLS // len(header)))
+                continue
+            lines.append(line)
+            if len(lines) == chunk_rows:
+                break
+        table = _to_table(header, dtypes, lines, sep) if lines else None
+        seconds += time.perf_counter() - start
+
+        if table is None:
+            break
+        nrows += len(table)
+        yield table
+
+    if stats is not None:
+        stats.add(nrows, nbytes, seconds)
+
+
+def iter_log(f: dict, schema: Schema, stats: ParseStats = None, sep: str = "\t"):
+    """
+    Streams a file found by find_log_files() like iter_tsv() over
+    open_log(). Files that are mapped() are instead memory-mapped and
+    parsed by iter_buffer() without decoding their text. If stats keeps
+    digests, the digest of the file is added once it is read to the end.
+    """
+    contents = f.get("f")
+    path = os.path.join(f["root"], f["fn"])
+    digest = None
+    if (
+        stats is not None
+        and stats.digests is not None
+        and not isinstance(contents, str)
+    ):
+        digest = content_digest()
+    if contents is None and mapped(path, os.path.getsize(path)):
+        with io.open(path, "rb") as fh:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                yield from iter_buffer(
+                    buffer, schema, stats=stats, sep=sep, digest=digest
+                )
+    else:
+        with open_log(f, digest) as stream:
+            yield from iter_tsv(stream, schema, stats=stats, sep=sep)
+    if digest is not None and (contents is None or isinstance(contents, bytes)):
+        stats.digests[path] = digest.hexdigest()
+
+
+def mapped(path: str, size: int):
+    """
+    Whether iter_log() parses a file of the given size from a memory map:
+    if it is uncompressed and has at least MAP_BYTES, and the pages of the
+    map can be released. The prefetcher leaves these files to the parser.
+    """
+    return (
+        MAP_RELEASE
+        and size >= MAP_BYTES
+        and os.path.splitext(path)[1] not in DECOMPRESSORS
+    )
+
+
+def read_log(f: dict, schema: Schema, stats: ParseStats = None, sep: str = "\t"):
+    """
+    Parses a whole file found by find_log_files() into a single Table: the
+    chunks yielded by iter_log() are concatenated column by column. A file
+    without body lines gives an empty Table.
+    """
+    return _concatenate(list(iter_log(f, schema, stats=stats, sep=sep)))
+
+
+def iter_buffer(
+    buffer,
+    schema: Schema,
+    chunk_bytes: int = MAP_CHUNK_BYTES,
+    stats: ParseStats = None,
+    sep: str = "\t",
+    digest=None,
+):
+    """
+    Streams a TSV file with a header line from a buffer of bytes, such as
+    a memory map of the file, and yields its body as Tables of the lines
+    in about chunk_bytes. Only a chunk of lines is copied out of the buffer
+    at a time, and the pages of a memory map are released once parsed.
+    The digest, if given, is updated with the bytes as they are parsed.
+    Tables with a label column followed by floating point columns are
+    parsed from bytes; chunks rejected by the byte parser, and other
+    tables, are decoded and parsed as by iter_tsv(), so that the results
+    are the same and the same files are rejected.
+    """
+    seconds, nrows = 0.0, 0
+    start = time.perf_counter()
+    pos, size = 0, len(buffer)
+    header = None
+    while header is None and pos < size:
+        end = buffer.find(b"\n", pos)
+        end = size if end < 0 else end + 1
+        line = buffer[pos:end]
+        if digest is not None:
+            digest.update(line)
+        line = line.decode("utf-8").rstrip("\r\n")
+        pos = end
+        if line:
+            header = line.split(sep)
+    if header is not None:
+        dtypes = schema.dtypes(header)
+        binary = (
+            len(sep) == 1
+            and len(header) > 1
+            and dtypes[0] is str
+            and all(np.issubdtype(dtype, np.floating) for dtype in dtypes[1:])
+        )
+    seconds += time.perf_counter() - start
+
+    while header is not None and pos < size:
+        start = time.perf_counter()
+        # The chunk ends with the last line ending within chunk_bytes
+        end = min(pos + chunk_bytes, size)
+        if end < size:
+            cut = buffer.rfind(b"\n", pos, end)
+            if cut < 0:
+                cut = buffer.find(b"\n", end)
+            end = size if cut < 0 else cut + 1
+        chunk = buffer[pos:end]
+        if digest is not None:
+            digest.update(chunk)
+        table = _bytes_to_table(header, dtypes, chunk, sep) if binary else None
+        if table is None:
+            lines = io.TextIOWrapper(io.BytesIO(chunk), encoding="utf-8")
+            lines = [line.rstrip("\r\n") for line in lines]
+            lines = [line for line in lines if line]
+            table = _to_table(header, dtypes, lines, sep) if lines else None
+        _release(buffer, pos, end)
+        pos = end
+        seconds += time.perf_counter() - start
+
+        if table is not None:
+            nrows += len(table)
+            yield table
+
+    if stats is not None:
+        stats.add(nrows, size, seconds)
+
+
+def _concatenate(tables: list):
+    """
+    Concatenates the chunks of a file column by column into a single
+    Table, or an empty Table if there are none.
+    """
+    if not tables:
+        return Table([], [])
+    if len(tables) == 1:
+        return tables[0]
+    columns = [np.concatenate(chunks) for chunks in zip(*(t.columns for t in tables))]
+    return Table(tables[0].header, columns)
+
+
+def _to_table(header: list, dtypes: list, lines: list, sep: str):
+    """
+    Converts the body lines of a TSV file into a Table. Splitting all lines
+    at once keeps the tokenizing in C; every line has to contribute exactly
+    one field per header column.
+    """
+    ncols = len(header)
+    fields = sep.join(lines).split(sep) if lines else []
+    if len(fields) != len(lines) * ncols:
+        raise ValueError(f"rows do not match the {ncols} columns of the header line")
+    columns = [
+        np.array(fields[i::ncols], dtype=dtype) for i, dtype in enumerate(dtypes)
+    ]
+    return Table(header, columns)
+
+
+def _bytes_to_table(header: list, dtypes: list, chunk: bytes, sep: str):
+    """
+    Converts a chunk of body lines of a TSV file, as bytes, into a Table of
+    a label column and floating point columns. The numeric columns are
+    converted from the bytes by NumPy's C parser, and the lines are found
+    from the offsets of their line endings rather than split into objects;
+    only the labels are gathered and decoded. Returns None if the parser
+    rejects the chunk.
+    """
+    ncols = len(header)
+    separator = sep.encode("utf-8")
+    if len(separator) != 1:
+        return None
+    data = np.frombuffer(chunk, dtype=np.uint8)
+    # Lone carriage returns end lines for the text parser
+    returns = np.count_nonzero(data == ord("\r"))
+    if returns and returns != chunk.count(b"\r\n"):
+        return None
+    newlines = np.flatnonzero(data == ord("\n"))
+    starts = np.concatenate(([0], newlines + 1))
+    stops = np.concatenate((newlines, [len(data)]))
+    crlf = stops > starts
+    crlf[crlf] = data[stops[crlf] - 1] == ord("\r")
+    stops -= crlf
+    starts = starts[stops > starts]
+    if not len(starts):
+        return None
+    try:
+        values = np.loadtxt(
+            io.BytesIO(chunk),
+            dtype=np.float64,
+            delimiter=sep,
+            comments=None,
+            usecols=range(1, ncols),
+            ndmin=2,
+            encoding="utf-8",
+        )
+    except ValueError:
+        return None
+    # The parser only reads the header columns of longer lines, so every
+    # line has to hold exactly ncols - 1 separators
+    separators = np.flatnonzero(data == separator[0])
+    if len(values) != len(starts) or len(separators) != len(starts) * (ncols - 1):
+        return None
+
+    # Gather the bytes of the labels, each followed by its separator
+    lengths = separators[:: ncols - 1] + 1 - starts
+    offsets = np.cumsum(lengths) - lengths
+    index = np.arange(offsets[-1] + lengths[-1]) + np.repeat(starts - offsets, lengths)
+    labels = data[index].tobytes().decode("utf-8").split(sep)[:-1]
+    columns = [np.array(labels, dtype=dtypes[0])]
+    columns += [values[:, i].astype(dtype) for i, dtype in enumerate(dtypes[1:])]
+    return Table(header, columns)
+
+
+def _release(buffer, start: int, end: int):
+    """
+    Releases the pages of a memory map between start and end once they are
+    parsed, so that they do not add up in the memory of the process.
+    """
+    if isinstance(buffer, mmap.mmap) and MAP_RELEASE:
+        start -= start % mmap.PAGESIZE
+        end -= end % mmap.PAGESIZE
+        if end > start:
+            buffer.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+
+def content_digest():
+    """
+    Returns a new hash of the contents of a file, as kept by the parse
+    cache.
+    """
+    return hashlib.blake2b(digest_size=20)
+
+
+class DigestReader(io.RawIOBase):
+    """
+    Reads a binary file, updating a digest with the bytes read.
+    """
+
+    def __init__(self, fh, digest):
+        self.fh = fh
+        self.digest = digest
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = self.fh.readinto(buffer)
+        if n:
+            self.digest.update(memoryview(buffer)[:n])
+        return n
+
+    def close(self):
+        self.fh.close()
+        super(DigestReader, self).close()
+
+
+@contextmanager
+def open_log(f: dict, digest=None):
+    """
+    Opens a file found by find_log_files() as a stream of text lines. The
+    contents or file handle in f["f"] are used when MultiQC (or the
+    prefetcher, as bytes) passed them, otherwise the file is opened from
+    its path and closed afterwards. Files with a .gz, .bz2 or .xz
+    extension are decompressed on the fly. The digest, if given, is
+    updated with the bytes of the file (read from its path or passed as
+    bytes) once the stream is read.
+    """
+    contents = f.get("f")
+    if isinstance(contents, str):
+        yield io.StringIO(contents)
+    elif isinstance(contents, bytes):
+        if digest is not None:
+            digest.update(contents)
+        opener = DECOMPRESSORS.get(os.path.splitext(f["fn"])[1])
+        if opener is None:
+            yield io.TextIOWrapper(io.BytesIO(contents), encoding="utf-8")
+        else:
+            with opener(io.BytesIO(contents), "rt", encoding="utf-8") as fh:
+                yield fh
+    elif contents is not None:
+        yield contents
+    elif digest is not None:
+        path = os.path.join(f["root"], f["fn"])
+        opener = DECOMPRESSORS.get(os.path.splitext(path)[1])
+        with io.BufferedReader(
+            DigestReader(io.open(path, "rb", buffering=0), digest)
+        ) as raw:
+            if opener is None:
+                fh = io.TextIOWrapper(raw, encoding="utf-8")
+            else:
+                fh = opener(raw, "rt", encoding="utf-8")
+            yield fh
+            # Hash any bytes the parser left unread
+            while raw.read(1 << 20):
+                pass
+    else:
+        path = os.path.join(f["root"], f["fn"])
+        opener = DECOMPRESSORS.get(os.path.splitext(path)[1], io.open)
+        with opener(path, "rt", encoding="utf-8") as fh:
+            yield fh
+
+
+def sniff_header(f: dict, signature, limit: int = SNIFF_BYTES, filesystem=None):
+    """
+    Checks that the header line of a file found by find_log_files() matches
+    the signature, a compiled regular expression, reading at most limit
+    bytes of the (decompressed) file, through the filesystem if given (see
+    the prefetch module). Unreadable files do not match.
+    """
+    contents = f.get("f")
+    if isinstance(contents, str):
+        head = contents[:limit].encode("utf-8")
+    else:
+        path = os.path.join(f["root"], f["fn"])
+        opener = DECOMPRESSORS.get(os.path.splitext(path)[1])
+        try:
+            if isinstance(contents, bytes):
+                fh = io.BytesIO(contents)
+            elif filesystem is not None:
+                fh = filesystem.open(path)
+            else:
+                fh = io.open(path, "rb")
+            with fh, opener(fh, "rb") if opener else fh as stream:
+                head = stream.read(limit)
+        except (OSError, EOFError, lzma.LZMAError):
+            return False
+    line = head.split(b"\n", 1)[0].rstrip(b"\r").decode("utf-8", errors="replace")
+    return signature.match(line) is not None
+
+
+def group_sum(labels: np.ndarray, values: np.ndarray):
+    """
+    Sums values sharing the same label. Returns the distinct labels in order
+    of first occurrence together with their sums.
+    """
+    uniq, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    sums = np.bincount(inverse.ravel(), weights=values, minlength=len(uniq))
+    order = np.argsort(first, kind="stable")
+    return uniq[order], sums[order]
@@ -0,0 +1,223 @@
+"""
+Prefetching of the files of the plugin modules.
+
+On network filesystems such as NFS or Lustre, opening a file and reading
+its first bytes take milliseconds, far longer than parsing a small file.
+Reading the files one after the other then leaves the CPU idle. A
+Prefetcher hides that latency with a pool of threads:
+
+- sniff() checks the header lines of many files concurrently
+- iter() reads the next files while the current one is being parsed, and
+  hands them over in order with their contents loaded
+
+At most "in_flight" files are read at once. The contents held in memory
+are bounded by "max_mb": a file (or pair of files) larger than its share of
+that budget is not prefetched, and is streamed by the parser as usual.
+Neither are the files the parser memory-maps (see parsing.mapped()), which
+it reads without copying them, nor the files that cannot be read, which
+the parser opens itself and handles as it would without prefetching. The
+threads only pay off for many files or large ones: below "min_mb" of files
+in total (by the sizes MultiQC found), a module reads its files directly.
+
+The prefetcher is set up by the "plugin_prefetch" section of the MultiQC
+config. Its "latency_ms" option reads the files through a LatencyFilesystem,
+a local stand-in for a network filesystem that waits before every open, to
+test and benchmark the prefetching without one.
+"""
+
+from __future__ import print_function
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import io
+import os
+import time
+
+from .parsing import mapped, sniff_header
+
+
+class LocalFilesystem(object):
+    """
+    Reads files from the local filesystem.
+    """
+
+    def size(self, path: str):
+        """
+        Size of a file in bytes.
+        """
+        return os.path.getsize(path)
+
+    def open(self, path: str):
+        """
+        Opens a file for reading in binary mode.
+        """
+        return io.open(path, "rb")
+
+
+class LatencyFilesystem(LocalFilesystem):
+    """
+    Local filesystem standing in for a network filesystem: looking up the
+    size of a file and opening it each wait latency seconds first. The
+    waits release the GIL, so concurrent reads overlap as they would on a
+    network filesystem.
+    """
+
+    def __init__(self, latency: float = 0.01):
+        self.latency = latency
+
+    def size(self, path: str):
+        time.sleep(self.latency)
+        return super(LatencyFilesystem, self).size(path)
+
+    def open(self, path: str):
+        time.sleep(self.latency)
+        return super(LatencyFilesystem, self).open(path)
+
+
+class Prefetcher(object):
+    """
+    Reads files ahead of their parsing in a pool of in_flight threads,
+    holding at most about max_bytes of contents. With in_flight set to 0,
+    the files are read through the filesystem one after the other (the
+    baseline to compare against); a disabled prefetcher, or files of less
+    than min_bytes in total, are left to the parsers.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        in_flight: int = 4,
+        max_bytes: float = 64e6,
+        filesystem: LocalFilesystem = None,
+        min_bytes: float = 1e6,
+    ):
+        self.enabled = enabled
+        self.in_flight = in_flight
+        self.max_bytes = max_bytes
+        self.min_bytes = min_bytes
+        self.filesystem = filesystem or LocalFilesystem()
+        # Files and bytes prefetched, and time spent waiting for them
+        self.files = 0
+        self.bytes = 0
+        self.waited = 0.0
+
+    @classmethod
+    def from_config(cls, prefetch_config: dict):
+        """
+        Returns the prefetcher set up by the "plugin_prefetch" section of
+        the MultiQC config.
+        """
+        prefetch_config = prefetch_config or {}
+        latency = prefetch_config.get("latency_ms", 0)
+        return cls(
+            enabled=prefetch_config.get("enabled", True),
+            in_flight=prefetch_config.get("in_flight", 4),
+            max_bytes=prefetch_config.get("max_mb", 64) * 1e6,
+            filesystem=LatencyFilesystem(latency / 1000) if latency else None,
+            min_bytes=prefetch_config.get("min_mb", 1) * 1e6,
+        )
+
+    @property
+    def item_bytes(self):
+        """
+        Largest size of a prefetched item: the files read ahead and the one
+        being parsed share the budget.
+        """
+        return self.max_bytes / (max(self.in_flight, 1) + 1)
+
+    def sniff(self, files: list, signature):
+        """
+        Checks the header lines of the files against the signature like
+        sniff_header(), reading in_flight files concurrently. Returns
+        whether each file matches.
+        """
+        sniff = partial(sniff_header, signature=signature, filesystem=self.filesystem)
+        if not self.enabled or not self.worthwhile(files):
+            return [sniff_header(f, signature) for f in files]
+        if self.in_flight < 2 or len(files) < 2:
+            return [sniff(f) for f in files]
+        with ThreadPoolExecutor(max_workers=self.in_flight) as pool:
+            return list(pool.map(sniff, files))
+
+    def iter(self, items):
+        """
+        Yields the items (files, or tuples of files) in order, each with
+        the contents of its files loaded in f["f"] if it fits the budget,
+        while the next in_flight items are read in the background.
+        """
+        items = list(items)
+        if not self.enabled or not self.worthwhile(items):
+            yield from items
+            return
+        if self.in_flight < 1:
+            for item in items:
+                yield self._take(item, None)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.in_flight) as pool:
+            pending = deque()
+            for item in items:
+                pending.append((item, pool.submit(self._read, item)))
+                if len(pending) > self.in_flight:
+                    yield self._take(*pending.popleft())
+            while pending:
+                yield self._take(*pending.popleft())
+
+    def worthwhile(self, items: list):
+        """
+        Returns whether the files of the items (files, or tuples of files)
+        add up to at least min_bytes, by the sizes MultiQC found for them.
+        """
+        total = 0
+        for item in items:
+            for f in item if isinstance(item, tuple) else (item,):
+                total += f.get("filesize", 0)
+                if total >= self.min_bytes:
+                    return True
+        return False
+
+    def summary(self):
+        """
+        Returns a one-line summary of the prefetched files.
+        """
+        return (
+            f"prefetched {self.files} files, {self.bytes / 1e6:.2f} MB, "
+            f"waited {self.waited:.3f}s for them"
+        )
+
+    def _read(self, item):
+        """
+        Reads the contents of the files of an item, or returns None if
+        they do not fit the budget, one of them is memory-mapped by the
+        parser or cannot be read; the parser then opens the files itself.
+        """
+        files = item if isinstance(item, tuple) else (item,)
+        paths = [os.path.join(f["root"], f["fn"]) for f in files]
+        try:
+            sizes = [self.filesystem.size(path) for path in paths]
+            if sum(sizes) > self.item_bytes or any(map(mapped, paths, sizes)):
+                return None
+            contents = []
+            for path in paths:
+                with self.filesystem.open(path) as fh:
+                    contents.append(fh.read())
+        except OSError:
+            return None
+        return contents
+
+    def _take(self, item, future):
+        """
+        Returns an item with the contents of its files, waiting for them
+        if they are still being read (or reading them if not submitted).
+        """
+        start = time.perf_counter()
+        contents = self._read(item) if future is None else future.result()
+        self.waited += time.perf_counter() - start
+        if contents is None:
+            return item
+
+        self.files += len(contents)
+        self.bytes += sum(len(data) for data in contents)
+        if isinstance(item, tuple):
+            return tuple(dict(f, f=data) for f, data in zip(item, contents))
+        return dict(item, f=contents[0])
@@ -0,0 +1,148 @@
+"""
+Per-phase instrumentation of the plugin modules.
+
+A module splits its run into phases (finding the files, parsing them,
+computing the statistics and building the report sections) and records for
+each of them the wall and CPU time, the number of files and bytes handled
+and, if enabled, the peak of the memory traced by tracemalloc. Phases nest:
+the time spent in an inner phase is not counted in the outer one.
+
+Recording a phase only reads the clocks when it starts and ends, so the
+profile is cheap enough to be kept on; tracing the memory slows down every
+allocation and is therefore off unless "trace_memory" is set in the
+"plugin_profiling" section of the MultiQC config. The peak of a phase needs
+tracemalloc.reset_peak() (Python 3.9); on older Pythons it would be the
+peak of the whole run so far, and no peak is recorded.
+"""
+
+from __future__ import print_function
+from contextlib import contextmanager
+import logging
+import time
+import tracemalloc
+
+from .parsing import ParseStats
+
+log = logging.getLogger(f"multiqc.{__name__}")
+
+
+class PhaseRecord(object):
+    """
+    Totals of one phase of a module.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.files = 0
+        self.bytes = 0
+        self.peak_memory = None
+
+    def to_dict(self):
+        """
+        Returns the totals as a dictionary.
+        """
+        return {
+            "calls": self.calls,
+            "wall_seconds": round(self.wall, 6),
+            "cpu_seconds": round(self.cpu, 6),
+            "files": self.files,
+            "bytes": self.bytes,
+            "peak_memory_bytes": self.peak_memory,
+        }
+
+
+class PhaseProfile(object):
+    """
+    Records the phases of a module run. A disabled profile records nothing.
+    """
+
+    def __init__(self, enabled: bool = True, trace_memory: bool = False):
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory
+        if self.trace_memory and not hasattr(tracemalloc, "reset_peak"):
+            log.warning("trace_memory needs Python 3.9 or later, not tracing")
+            self.trace_memory = False
+        self.phases = dict()
+        self.stack = []
+        # Once started, the tracing of the memory stays on for the other
+        # modules of the run
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @classmethod
+    def from_config(cls, profiling_config: dict):
+        """
+        Returns the profile set up by the "plugin_profiling" section of the
+        MultiQC config.
+        """
+        profiling_config = profiling_config or {}
+        return cls(
+            enabled=profiling_config.get("enabled", True),
+            trace_memory=profiling_config.get("trace_memory", False),
+        )
+
+    @contextmanager
+    def phase(self, name: str, stats: ParseStats = None):
+        """
+        Records the enclosed code as the named phase and yields its record.
+        The files and bytes added to stats in the phase are counted for it.
+        """
+        record = self.phases.setdefault(name, PhaseRecord())
+        if not self.enabled:
+            yield record
+            return
+
+        files, nbytes = (stats.files, stats.bytes) if stats is not None else (0, 0)
+        self._pause()
+        self.stack.append(record)
+        record.calls += 1
+        self._resume()
+        try:
+            yield record
+        finally:
+            self._pause()
+            self.stack.pop()
+            self._resume()
+            if stats is not None:
+                record.files += stats.files - files
+                record.bytes += stats.bytes - nbytes
+
+    def _resume(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+
+    def _pause(self):
+        if not self.stack:
+            return
+        record = self.stack[-1]
+        record.wall += time.perf_counter() - self._wall
+        record.cpu += time.process_time() - self._cpu
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            record.peak_memory = max(record.peak_memory or 0, peak)
+
+    def to_dict(self):
+        """
+        Returns the {phase: totals} dictionary written to the report data.
+        """
+        return {name: record.to_dict() for name, record in self.phases.items()}
+
+    def summary(self):
+        """
+        Returns a one-line summary of the time spent in each phase.
+        """
+        parts = []
+        for name, record in self.phases.items():
+            part = f"{name} {record.wall:.3f}s"
+            if record.bytes:
+                part += f" ({record.files} files, {record.bytes / 1e6:.2f} MB)"
+            elif record.files:
+                part += f" ({record.files} files)"
+            if record.peak_memory is not None:
+                part += f" peak {record.peak_memory / 1e6:.1f} MB"
+            parts.append(part)
+        return "profile: " + ", ".join(parts)
@@ -0,0 +1,199 @@
+"""
+Fixed-bin histogram of TIN scores.
+
+TIN scores lie between 0 and 100, so the bins of a histogram are laid out
+once for a given bin width and the counts are kept in a preallocated array.
+Scores are added chunk by chunk while a file is streamed, so the memory
+used does not depend on the number of transcripts in the file. A TinSketch
+is a fine-grained histogram used to summarise the scores of a sample by
+their quantiles without keeping the scores themselves.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+
+class TinHistogram(object):
+    """
+    Counts of TIN scores in bins of a fixed width centred on the multiples
+    of the width between lower and upper. Scores outside of that range and
+    missing (NaN) scores are counted separately.
+    """
+
+    def __init__(
+        self, bin_width: float = 1.0, lower: float = 0.0, upper: float = 100.0
+    ):
+        if bin_width <= 0:
+            raise ValueError(f"bin width has to be positive, got {bin_width}")
+        self.bin_width = float(bin_width)
+        self.lower = float(lower)
+        self.nbins = int(np.floor((upper - lower) / self.bin_width + 0.5)) + 1
+        self.counts = np.zeros(self.nbins, dtype=np.int64)
+        self.outside = 0
+        self.missing = 0
+        # Sum of the binned scores, for their exact mean
+        self.total = 0.0
+
+    @property
+    def layout(self):
+        """
+        Bin layout of the histogram; histograms with the same layout can
+        be merged.
+        """
+        return (self.lower, self.bin_width, self.nbins)
+
+    @property
+    def centres(self):
+        """
+        Centre of each bin.
+        """
+        return self.lower + np.arange(self.nbins) * self.bin_width
+
+    def update(self, scores: np.ndarray):
+        """
+        Adds a chunk of TIN scores to the histogram.
+        """
+        update_batch([self], scores[:, np.newaxis])
+
+    def merge(self, other: "TinHistogram"):
+        """
+        Adds the counts of another histogram with the same bin layout.
+        """
+        if other.layout != self.layout:
+            raise ValueError(
+                f"cannot merge histograms with bin layouts {self.layout} "
+                f"and {other.layout}"
+            )
+        self.counts += other.counts
+        self.outside += other.outside
+        self.missing += other.missing
+        self.total += other.total
+
+    def to_dict(self):
+        """
+        Returns the {bin centre: count} dictionary of the non-empty bins
+        expected by linegraph.plot(). Bin centres are integers for integer
+        bin widths.
+        """
+        nonzero = np.flatnonzero(self.counts)
+        centres = self.labels[nonzero]
+        return dict(zip(centres.tolist(), self.counts[nonzero].tolist()))
+
+    @property
+    def labels(self):
+        """
+        Centre of each bin as plotted: integers for integer bin widths,
+        otherwise rounded to one decimal more than the bin width.
+        """
+        if self.bin_width.is_integer() and self.lower.is_integer():
+            return self.centres.astype(np.int64)
+        decimals = max(0, -int(np.floor(np.log10(self.bin_width)))) + 1
+        return np.round(self.centres, decimals)
+
+
+class TinSketch(TinHistogram):
+    """
+    Mergeable streaming quantile summary of TIN scores: a histogram with
+    narrow bins (the resolution), from which quantiles and the fraction of
+    scores below a value are read with an error of at most half a bin
+    width. The mean is exact.
+    """
+
+    def __init__(self, resolution: float = 0.1):
+        super(TinSketch, self).__init__(bin_width=resolution)
+
+    @property
+    def size(self):
+        """
+        Number of binned scores.
+        """
+        return int(self.counts.sum())
+
+    def _edges(self):
+        """
+        Lower bin edges followed by the upper edge of the last bin, and the
+        number of scores below each of these edges.
+        """
+        edges = np.append(self.centres, self.centres[-1] + self.bin_width)
+        below = np.concatenate(([0], np.cumsum(self.counts)))
+        return edges - self.bin_width / 2, below
+
+    def mean(self):
+        """
+        Mean of the binned scores.
+        """
+        return self.total / self.size if self.size else np.nan
+
+    def quantile(self, q: float):
+        """
+        Estimates the q-th quantile (0 <= q <= 1) of the scores by linear
+        interpolation within the bin holding it.
+        """
+        if not self.size:
+            return np.nan
+        edges, below = self._edges()
+        target = q * self.size
+        # First bin reaching the target, skipping empty bins
+        i = min(max(int(np.searchsorted(below, target)), 1), self.nbins)
+        i = int(np.flatnonzero(self.counts[i - 1 :])[0]) + i - 1
+        fraction = (target - below[i]) / self.counts[i]
+        value = edges[i] + min(max(fraction, 0.0), 1.0) * self.bin_width
+        # The outer bins extend half a bin width beyond the range of scores
+        return float(np.clip(value, self.lower, self.centres[-1]))
+
+    def fraction_below(self, value: float):
+        """
+        Estimates the fraction of the scores lower than value.
+        """
+        if not self.size:
+            return np.nan
+        edges, below = self._edges()
+        return float(np.interp(value, edges, below) / self.size)
+
+
+def density_matrix(histograms: list):
+    """
+    Stacks histograms with the same bin layout into a histograms x bins
+    matrix of the fraction of the binned scores of each histogram in each
+    bin. Rows of empty histograms are zero.
+    """
+    first = histograms[0]
+    if any(hist.layout != first.layout for hist in histograms):
+        raise ValueError("histograms stacked together need the same bin layout")
+    counts = np.stack([hist.counts for hist in histograms]).astype(np.float64)
+    totals = counts.sum(axis=1, keepdims=True)
+    return np.divide(counts, totals, out=np.zeros_like(counts), where=totals > 0)
+
+
+def update_batch(histograms: list, scores: np.ndarray):
+    """
+    Adds a chunk of a transcripts x samples matrix of TIN scores to one
+    histogram per column, in a single pass over the matrix. All histograms
+    need the same bin layout.
+    """
+    first = histograms[0]
+    if any(hist.layout != first.layout for hist in histograms):
+        raise ValueError("histograms updated together need the same bin layout")
+
+    missing = np.isnan(scores)
+    # np.round() rounds halves to even, like the built-in round()
+    # used for the original 1-wide bins
+    with np.errstate(invalid="ignore"):
+        index = np.round((scores - first.lower) / first.bin_width)
+    inside = ~missing & (index >= 0) & (index < first.nbins)
+
+    # Shifting the bins of column j by j * nbins counts all columns at once
+    index = index + np.arange(scores.shape[1]) * first.nbins
+    counts = np.bincount(
+        index[inside].astype(np.intp), minlength=scores.shape[1] * first.nbins
+    ).reshape(scores.shape[1], first.nbins)
+
+    nmissing = missing.sum(axis=0)
+    noutside = scores.shape[0] - nmissing - inside.sum(axis=0)
+    totals = np.where(inside, scores, 0.0).sum(axis=0)
+    for j, hist in enumerate(histograms):
+        hist.counts += counts[j]
+        hist.missing += int(nmissing[j])
+        hist.outside += int(noutside[j])
+        hist.total += float(totals[j])
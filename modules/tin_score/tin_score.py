@@ -12,14 +12,103 @@
 ###############################################################################
 
 from __future__ import print_function
+from functools import partial
 import logging
 import os
+import re
 
-from multiqc.plots import linegraph
+import numpy as np
 from multiqc.modules.base_module import BaseMultiqcModule
+from multiqc.utils import config
 
-# Initialise the logger
-log = logging.getLogger(__name__)
+from .histogram import TinHistogram, TinSketch, density_matrix, update_batch
+from .transcripts import TranscriptMatrix
+from ..cache import ParseCache
+from ..compaction import PlotCompactor
+from ..export import Exporter
+from ..parallel import parse_files, parse_workers
+from ..parsing import (
+    Column,
+    ParseStats,
+    Schema,
+    iter_log,
+    read_log,
+)
+from ..prefetch import Prefetcher
+from ..profiling import PhaseProfile
+
+# Initialise the logger under the "multiqc" logger so that it reaches its handlers
+log = logging.getLogger(f"multiqc.{__name__}")
+
+# Layout of the TIN_score.tsv files: transcript and the sample's TIN score
+TIN_SCHEMA = Schema([Column("transcript", str), Column(None, np.float64)])
+
+# Layout of the merged TIN_scores_merged.tsv files: transcript and
+# the TIN score of each sample
+TIN_MATRIX_SCHEMA = Schema([Column("transcript", str)], rest=np.float64)
+
+# Header line of both kinds of files, checked before parsing
+TIN_HEADER = re.compile(r"transcript\t")
+
+
+def parse_tin_score_logs(
+    f: dict,
+    stats: ParseStats = None,
+    bin_width: float = 1,
+    sketch_resolution: float = 0.1,
+):
+    """
+    Streams the tsv file through a fixed-bin histogram of
+    the TIN-scores and a quantile sketch of them, and returns both.
+    This is a module-level function so that it can run in parse workers.
+    """
+    histogram = TinHistogram(bin_width)
+    sketch = TinSketch(sketch_resolution)
+
+    """
+    We bin the values in the tsv file by rounding them
+    For example if in the tsv file, we have 75.0764183691,
+    it has been rounded to 75.0. This is done because
+    75.0764183691 is a very unique number and the the
+    probability that another transcript will have the same number
+    is extremely low, almost impossible. Therefore rounding here
+    is an effective binning strategy because it serves as
+    histogram 'bins' and we have better visualization of
+    data. The width of the bins is set by the "bin_width" option.
+    """
+    for chunk in iter_log(f, TIN_SCHEMA, stats=stats):
+        histogram.update(chunk[1])
+        sketch.update(chunk[1])
+
+    return histogram, sketch
+
+
+def parse_tin_score_matrix(
+    f: dict,
+    stats: ParseStats = None,
+    bin_width: float = 1,
+    sketch_resolution: float = 0.1,
+):
+    """
+    Streams a merged transcripts x samples tsv file and returns
+    a dictionary with the TIN-score histogram and quantile sketch
+    of each sample. All samples of a chunk of rows are binned in
+    one batched pass.
+    """
+    histograms, sketches = [], []
+
+    for chunk in iter_log(f, TIN_MATRIX_SCHEMA, stats=stats):
+        if not histograms:
+            for sample in chunk.header[1:]:
+                histograms.append(TinHistogram(bin_width))
+                sketches.append(TinSketch(sketch_resolution))
+        scores = np.column_stack(chunk.columns[1:])
+        update_batch(histograms, scores)
+        update_batch(sketches, scores)
+
+    if not histograms:
+        return dict()
+    return dict(zip(chunk.header[1:], zip(histograms, sketches)))
 
 
 class MultiqcModule(BaseMultiqcModule):
@@ -43,9 +132,67 @@ class MultiqcModule(BaseMultiqcModule):
                 Number (TIN) for each transcript.",
         )
 
-        self.samples = []
+        # Module options, set under "tin_score_config" in the MultiQC config
+        tin_config = getattr(config, "tin_score_config", {})
+        self.bin_width = tin_config.get("bin_width", 1)
+        self.low_tin_threshold = tin_config.get("low_tin_threshold", 50)
+        self.sketch_resolution = tin_config.get("sketch_resolution", 0.1)
+        # Large cohorts: above heatmap_threshold samples the histograms are
+        # plotted as a samples x bins heatmap instead of one line per sample,
+        # its rows ordered by heatmap_order ("median" TIN, or "none")
+        self.heatmap_threshold = tin_config.get("heatmap_threshold", 200)
+        self.heatmap_order = tin_config.get("heatmap_order", "median")
+        # Transcripts: the scores of each transcript in each sample are kept
+        # in a memory-mapped matrix (in transcript_matrix_dir if set, or
+        # a temporary file) to report the top_transcripts most variable and
+        # most degraded transcripts
+        self.transcript_matrix = tin_config.get("transcript_matrix", False)
+        self.transcript_matrix_dir = tin_config.get("transcript_matrix_dir")
+        self.top_transcripts = tin_config.get("top_transcripts", 20)
+        self.transcript_outlier_z = tin_config.get("transcript_outlier_z", 3.0)
+        self.parse_workers = parse_workers(tin_config)
+        self.cache = ParseCache.from_config(getattr(config, "plugin_parse_cache", None))
+        self.profile = PhaseProfile.from_config(
+            getattr(config, "plugin_profiling", None)
+        )
+        self.exporter = Exporter.from_config(
+            getattr(config, "plugin_export", None), config.data_dir
+        )
+        self.compactor = PlotCompactor.from_config(
+            getattr(config, "plugin_compaction", None)
+        )
+        self.prefetcher = Prefetcher.from_config(
+            getattr(config, "plugin_prefetch", None)
+        )
+
+        self.parse_stats = ParseStats()
+        self.samples = set()
+        self.histograms = dict()
+        self.sketches = dict()
         self.number = 0
+        self.transcripts = None
+        self.transcript_stats = ParseStats()
         self.findLogs()
+        with self.profile.phase("compute"):
+            self.tin_summary_stats()
+        if self.transcript_matrix:
+            self.transcript_summary()
+        if self.parse_stats.files:
+            log.info(self.parse_stats.summary())
+        if self.cache is not None:
+            log.info(self.cache.summary())
+            self.cache.close()
+        if self.exporter.written:
+            log.info(self.exporter.summary())
+        if self.compactor.plots:
+            log.info(self.compactor.summary())
+        if self.prefetcher.files:
+            log.info(self.prefetcher.summary())
+        if self.profile.enabled:
+            log.info(self.profile.summary())
+            self.write_data_file(
+                self.profile.to_dict(), "multiqc_tin_score_profile", data_format="json"
+            )
 
     def get_sample_name(self, f: dict):
         """
@@ -54,75 +201,373 @@ class MultiqcModule(BaseMultiqcModule):
         sample = os.path.split(os.path.split(f["root"])[0])[1]
         return sample
 
+    def find_tin_files(self, sp_key: str):
+        """
+        Returns the files found for a search pattern whose header line is
+        that of a TIN score file, as other tools write files with the same
+        names. The headers are read concurrently by the prefetcher.
+        """
+        found = list(self.find_log_files(sp_key, filecontents=False))
+        files = []
+        for f, match in zip(found, self.prefetcher.sniff(found, TIN_HEADER)):
+            if match:
+                files.append(f)
+            else:
+                log.debug(
+                    f"Skipping {os.path.join(f['root'], f['fn'])}: not a TIN score file"
+                )
+        return files
+
     def findLogs(self):
         """
         Find files matching with the regex in and passes them to the
         parsing function one by one and also plots the graph in the end.
+        Merged transcripts x samples matrices are read first; per-sample
+        files of samples already found in a matrix are not opened.
         """
-        data = dict()
+        binning = dict(
+            bin_width=self.bin_width, sketch_resolution=self.sketch_resolution
+        )
+        # Cached results are only valid for the same binning
+        namespace = f"bin_width={self.bin_width}:resolution={self.sketch_resolution}"
 
-        for f in self.find_log_files("tin-score"):
-            sample = self.get_sample_name(f)
-            data.setdefault(sample, {})
-            if sample not in self.samples:
-                self.number = self.number + 1
-                self.samples = self.samples + [sample]
-                sample_data = self.parse_tin_score_logs(f)
+        with self.profile.phase("find") as found:
+            matrices = self.find_tin_files("tin-score/merged")
+            found.files += len(matrices)
+        with self.profile.phase("parse", stats=self.parse_stats):
+            parsed_matrices = parse_files(
+                partial(parse_tin_score_matrix, **binning),
+                matrices,
+                self.parse_workers,
+                self.parse_stats,
+                cache=self.cache,
+                namespace=f"tin-score/merged:{namespace}",
+                prefetcher=self.prefetcher,
+            )
+        for parsed in parsed_matrices:
+            self.number = self.number + 1
+            for sample, (histogram, sketch) in parsed.items():
+                if sample not in self.samples:
+                    self.samples.add(sample)
+                    self.histograms[sample] = histogram
+                    self.sketches[sample] = sketch
 
-                data[sample].update(sample_data)
+        files = dict()
+        with self.profile.phase("find") as found:
+            for f in self.find_tin_files("tin-score"):
+                found.files += 1
+                sample = self.get_sample_name(f)
+                if sample not in self.samples and sample not in files:
+                    files[sample] = f
+
+        with self.profile.phase("parse", stats=self.parse_stats):
+            parsed = parse_files(
+                partial(parse_tin_score_logs, **binning),
+                list(files.values()),
+                self.parse_workers,
+                self.parse_stats,
+                cache=self.cache,
+                namespace=f"tin-score:{namespace}",
+                prefetcher=self.prefetcher,
+            )
+        for sample, (histogram, sketch) in zip(files, parsed):
+            self.number = self.number + 1
+            self.samples.add(sample)
+            self.histograms[sample] = histogram
+            self.sketches[sample] = sketch
 
         if self.number == 0:
             raise UserWarning
 
+        if self.transcript_matrix:
+            with self.profile.phase("transcripts", stats=self.transcript_stats):
+                self.fill_transcript_matrix(matrices, files)
+
+        with self.profile.phase("export"):
+            self.export_histograms()
+
+        with self.profile.phase("sections"):
+            if len(self.histograms) > self.heatmap_threshold:
+                self.print_tin_heatmap()
+            else:
+                # Deferred until there is a plot, as the plot modules import
+                # matplotlib
+                from multiqc.plots import linegraph
+
+                pconfig = {"id": "tin_score_plot"}
+                data = self.compactor.linegraph(
+                    pconfig["id"],
+                    {
+                        sample: hist.to_dict()
+                        for sample, hist in self.histograms.items()
+                    },
+                )
+                self.add_section(
+                    name="",
+                    anchor="tin-score",
+                    plot=linegraph.plot(data, pconfig),
+                )
+
+    def print_tin_heatmap(self):
+        """
+        Plots the TIN-score histograms of a large cohort as one heatmap,
+        with a row per sample holding the percentage of its transcripts
+        in each bin. Bins empty in every sample at either end of the range
+        are left out.
+        """
+        # Deferred until there is a plot, as the plot modules import matplotlib
+        from multiqc.plots import heatmap
+
+        samples = list(self.histograms)
+        density = density_matrix(list(self.histograms.values())) * 100
+        sort = self.heatmap_order == "median"
+        if sort:
+            medians = np.array(
+                [self.sketches[sample].quantile(0.5) for sample in samples]
+            )
+            # Samples without scores have a NaN median and come last
+            order = np.argsort(medians, kind="stable")
+            density = density[order]
+            samples = [samples[i] for i in order]
+
+        labels = next(iter(self.histograms.values())).labels
+        occupied = np.flatnonzero(density.any(axis=0))
+        if occupied.size:
+            density = density[:, occupied[0] : occupied[-1] + 1]
+            labels = labels[occupied[0] : occupied[-1] + 1]
+        log.info(f"{len(samples)} samples, plotting the TIN scores as a heatmap")
+
+        pconfig = {
+            "id": "tin_score_heatmap",
+            "title": "TIN scores: distribution per sample",
+            "xTitle": "TIN score",
+            "yTitle": "Sample",
+            "square": False,
+            "xcats_samples": False,
+            "ycats_samples": True,
+            "min": 0,
+            "datalabels": False,
+            "borderWidth": 0,
+        }
+
         self.add_section(
             name="",
             anchor="tin-score",
-            plot=linegraph.plot(data),
+            description="Percentage of the transcripts of each sample (rows) "
+            "in each TIN-score bin (columns)."
+            + (" Samples are ordered by their median TIN." if sort else ""),
+            plot=heatmap.plot(
+                self.compactor.heatmap(pconfig["id"], density),
+                [str(label) for label in labels.tolist()],
+                samples,
+                pconfig,
+            ),
+        )
+
+    def export_histograms(self):
+        """
+        Writes the TIN-score histograms as a samples x bins matrix of
+        counts, with the counts of scores outside of the bins and missing.
+        """
+        histograms = list(self.histograms.values())
+        self.exporter.write(
+            "multiqc_tin_score_histograms",
+            list(self.histograms),
+            histograms[0].centres,
+            {"counts": np.stack([hist.counts for hist in histograms])},
+            columns_name="bins",
+            extra={
+                "outside": [hist.outside for hist in histograms],
+                "missing": [hist.missing for hist in histograms],
+            },
         )
 
-    def parse_tin_score_logs(self, f: dict):
+    def fill_transcript_matrix(self, matrices: list, files: dict):
         """
-        Parses the tsv file by storing the count of TIN-score in
-        a dictionary.
+        Streams the merged matrices, then the per-sample files, into the
+        memory-mapped transcripts x samples matrix. The files are read again
+        rather than kept from the parse, so that only a chunk of rows or a
+        single sample is in memory at once.
         """
-        sample_data = dict()
-        word = []
-        words = []
-        listToStr1 = []
-        listToStr = []
+        self.transcripts = TranscriptMatrix(self.transcript_matrix_dir)
+        for f in matrices:
+            keep = None
+            for chunk in iter_log(f, TIN_MATRIX_SCHEMA, stats=self.transcript_stats):
+                # Samples of the matrix found in an earlier file are left out
+                if keep is None:
+                    keep, columns = self.transcripts.new_columns(chunk.header[1:])
+                if keep:
+                    self.transcripts.write(
+                        columns,
+                        chunk[0].tolist(),
+                        np.column_stack([chunk[1 + j] for j in keep]),
+                    )
+        for sample, f in zip(files, self.prefetcher.iter(list(files.values()))):
+            table = read_log(f, TIN_SCHEMA, stats=self.transcript_stats)
+            if len(table):
+                self.transcripts.add_sample(sample, table[0].tolist(), table[1])
 
-        for char in f["f"]:
-            if char != "\t" and char != "\n":
-                word.append(char)
-            else:
-                words.append(word)
-                word = []
-
-        # Concatinating each character
-        for k in words:
-            listToStr1.append("".join([str(elem) for elem in k]))
-        # Conactinating each word
-        for k in listToStr1:
-            listToStr.append("".join([str(elem) for elem in k]))
-
-        for i in range(len(listToStr)):
-            if i < 2:
-                continue
-            if i % 2 == 1:
-                """
-                We have rounded the values in the tsv file
-                For example if in the tsv file, we have 75.0764183691,
-                it has been rounded to 75.0. This is done because
-                75.0764183691 is a very unique number and the the
-                probability that another transcript will have the same number
-                is extremely low, almost impossible. Therefore rounding here
-                is an effective binning strategy because it serves as
-                histogram 'bins' and we have better visualization of
-                data.
-                """
-                sample_data.setdefault(round(float(listToStr[i])), 0)
-                sample_data[round(float(listToStr[i]))] = (
-                    sample_data[round(float(listToStr[i]))] + 1
+    def transcript_summary(self):
+        """
+        Computes the statistics of each transcript across the samples out
+        of core and adds tables of the most variable and the most degraded
+        transcripts to the report.
+        """
+        # Deferred until there is a plot, as the plot modules import matplotlib
+        from multiqc.plots import table
+
+        with self.profile.phase("compute"):
+            stats = self.transcripts.statistics(
+                self.low_tin_threshold, self.transcript_outlier_z
+            )
+            names = list(self.transcripts.transcripts)
+            # Transcripts scored in a single sample have no variance
+            scored = np.flatnonzero(stats["samples"] > 1)
+            rankings = {
+                "variable": scored[np.argsort(-stats["sd"][scored], kind="stable")],
+                "degraded": scored[np.argsort(stats["mean"][scored], kind="stable")],
+            }
+        log.info(
+            f"transcript matrix: {self.transcripts.shape[0]} transcripts x "
+            f"{self.transcripts.shape[1]} samples"
+        )
+
+        headers = {
+            "mean_tin": {
+                "title": "Mean TIN",
+                "min": 0,
+                "max": 100,
+                "scale": "RdYlGn",
+                "format": "{:,.1f}",
+            },
+            "sd_tin": {
+                "title": "TIN SD",
+                "min": 0,
+                "scale": "Blues",
+                "format": "{:,.1f}",
+            },
+            "low_tin_percent": {
+                "title": f"% TIN < {self.low_tin_threshold}",
+                "description": "Percentage of the samples with a transcript "
+                f"integrity number below {self.low_tin_threshold}",
+                "min": 0,
+                "max": 100,
+                "suffix": "%",
+                "scale": "OrRd",
+                "format": "{:,.1f}",
+            },
+            "outliers": {
+                "title": "Outliers",
+                "description": "Samples more than "
+                f"{self.transcript_outlier_z} SDs away from the mean TIN",
+                "min": 0,
+                "scale": "Purples",
+                "format": "{:,.0f}",
+            },
+            "samples": {
+                "title": "Samples",
+                "description": "Samples in which the transcript was scored",
+                "min": 0,
+                "format": "{:,.0f}",
+                "hidden": True,
+            },
+        }
+        titles = {
+            "variable": "Most variable transcripts",
+            "degraded": "Most degraded transcripts",
+        }
+        with self.profile.phase("sections"):
+            for kind, order in rankings.items():
+                data = dict()
+                for i in order[: self.top_transcripts].tolist():
+                    data[names[i]] = {
+                        "mean_tin": stats["mean"][i],
+                        "sd_tin": stats["sd"][i],
+                        "low_tin_percent": stats["low"][i] / stats["samples"][i] * 100,
+                        "outliers": int(stats["outliers"][i]),
+                        "samples": int(stats["samples"][i]),
+                    }
+                self.add_section(
+                    name=titles[kind],
+                    anchor=f"tin-score-{kind}-transcripts",
+                    description=f"The {len(data)} transcripts with the "
+                    + ("highest SD" if kind == "variable" else "lowest mean")
+                    + " of their TIN scores across the samples.",
+                    plot=table.plot(
+                        data,
+                        headers,
+                        {
+                            "id": f"tin_score_{kind}_transcripts",
+                            "namespace": "TIN scores",
+                            "col1_header": "Transcript",
+                            "sortRows": False,
+                        },
+                    ),
                 )
+                self.write_data_file(data, f"multiqc_tin_score_{kind}_transcripts")
+
+        if self.transcript_matrix_dir is not None:
+            path = self.transcripts.save(
+                self.transcript_matrix_dir, overwrite=config.force
+            )
+            log.info(f"Saved the transcript matrix to {path}")
+        self.transcripts.close()
+
+    def tin_summary_stats(self):
+        """
+        Summarises the TIN-scores of each sample from its quantile
+        sketch and adds the summaries to the general statistics
+        table and to the multiqc_data directory.
+        """
+        data = dict()
+        for sample, sketch in self.sketches.items():
+            quartiles = [sketch.quantile(q) for q in (0.25, 0.5, 0.75)]
+            data[sample] = {
+                "median_tin": quartiles[1],
+                "mean_tin": sketch.mean(),
+                "iqr_tin": quartiles[2] - quartiles[0],
+                "low_tin_percent": sketch.fraction_below(self.low_tin_threshold) * 100,
+            }
+
+        headers = {
+            "median_tin": {
+                "title": "Median TIN",
+                "description": "Median transcript integrity number",
+                "min": 0,
+                "max": 100,
+                "scale": "RdYlGn",
+                "format": "{:,.1f}",
+            },
+            "mean_tin": {
+                "title": "Mean TIN",
+                "description": "Mean transcript integrity number",
+                "min": 0,
+                "max": 100,
+                "scale": "RdYlGn",
+                "format": "{:,.1f}",
+                "hidden": True,
+            },
+            "iqr_tin": {
+                "title": "TIN IQR",
+                "description": "Interquartile range of the transcript "
+                "integrity numbers",
+                "min": 0,
+                "max": 100,
+                "scale": "Blues",
+                "format": "{:,.1f}",
+                "hidden": True,
+            },
+            "low_tin_percent": {
+                "title": f"% TIN < {self.low_tin_threshold}",
+                "description": "Percentage of transcripts with a transcript "
+                f"integrity number below {self.low_tin_threshold}",
+                "min": 0,
+                "max": 100,
+                "suffix": "%",
+                "scale": "OrRd",
+                "format": "{:,.1f}",
+            },
+        }
 
-        return sample_data
+        self.general_stats_addcols(data, headers)
+        self.write_data_file(data, "multiqc_tin_score")
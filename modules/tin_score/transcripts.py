@@ -0,0 +1,268 @@
+"""
+Memory-mapped transcripts x samples matrix of TIN scores.
+
+The histograms of the tin-score module summarise each sample and lose the
+identity of the transcripts. A TranscriptMatrix keeps the scores of every
+transcript in every sample as float32 in a memory-mapped file, so that the
+transcripts that are degraded or variable across a cohort can be found
+without holding the matrix in memory: 60,000 transcripts x 5,000 samples
+take 1.2 GB on disk.
+
+The matrix is stored column by column (Fortran order), so that the scores
+of a sample are written, and blocks of samples read, sequentially. The rows
+are looked up in a hashed index of the transcript names. Cells of
+transcripts missing from a sample hold NaN.
+"""
+
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# Number of bytes of the matrix read at once by TranscriptMatrix.statistics()
+BLOCK_BYTES = 1 << 24
+
+
+class TranscriptMatrix(object):
+    """
+    Transcripts x samples float32 matrix of TIN scores in a memory-mapped
+    file, created under a unique name in directory (a temporary directory by
+    default), so that runs sharing the directory do not overwrite each
+    other's matrix. The file grows as transcripts and samples are added.
+    """
+
+    def __init__(self, directory: str = None, transcripts: int = 1024):
+        self.tmpdir = None
+        if directory is None:
+            directory = self.tmpdir = tempfile.mkdtemp(prefix="tin_scores_")
+        else:
+            os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(
+            prefix="tin_scores_", suffix=".f32", dir=directory
+        )
+        os.close(fd)
+
+        # Interned labels: name -> row / column of the matrix
+        self.transcripts = dict()
+        self.samples = dict()
+        # Rows of the transcripts of the last added sample, reused for the
+        # next sample if it lists the same transcripts in the same order
+        self._last_names = None
+        self._last_rows = None
+
+        # Only the top-left len(transcripts) x len(samples) block is in use
+        self._map = None
+        self._allocate((max(transcripts, 1), 16))
+
+    @property
+    def shape(self):
+        """
+        Number of transcripts and samples stored.
+        """
+        return (len(self.transcripts), len(self.samples))
+
+    def _allocate(self, shape: tuple, old: np.memmap = None):
+        """
+        Maps a file of the given capacity, filled with NaN, and copies the
+        used block of the old map into it.
+        """
+        path = self.path if old is None else self.path + ".new"
+        new = np.memmap(path, dtype=np.float32, mode="w+", shape=shape, order="F")
+        new[:] = np.nan
+        if old is not None:
+            rows = min(len(self.transcripts), old.shape[0])
+            cols = min(len(self.samples), old.shape[1])
+            step = self._block_columns(rows)
+            for start in range(0, cols, step):
+                stop = min(cols, start + step)
+                new[:rows, start:stop] = old[:rows, start:stop]
+            new.flush()
+            del old
+            os.replace(path, self.path)
+            new = np.memmap(
+                self.path, dtype=np.float32, mode="r+", shape=shape, order="F"
+            )
+        self._map = new
+
+    def _reserve(self, rows: int, cols: int):
+        """
+        Makes sure the file can hold rows transcripts and cols samples.
+        New samples are appended to the file; new transcripts need a copy.
+        """
+        capacity_rows, capacity_cols = self._map.shape
+        if rows > capacity_rows:
+            self._map.flush()
+            self._allocate(
+                (max(rows, 2 * capacity_rows), max(cols, capacity_cols)), self._map
+            )
+        elif cols > capacity_cols:
+            shape = (capacity_rows, max(cols, 2 * capacity_cols))
+            self._map.flush()
+            self._map = None
+            with open(self.path, "r+b") as fh:
+                fh.truncate(shape[0] * shape[1] * 4)
+            self._map = np.memmap(
+                self.path, dtype=np.float32, mode="r+", shape=shape, order="F"
+            )
+            self._map[:, capacity_cols:] = np.nan
+
+    def _rows(self, names: list):
+        """
+        Returns the rows of the transcripts, adding those not seen so far.
+        """
+        if names == self._last_names:
+            return self._last_rows
+        index = self.transcripts
+        rows = np.array(
+            [index.setdefault(name, len(index)) for name in names], dtype=np.intp
+        )
+        self._last_names, self._last_rows = names, rows
+        return rows
+
+    def new_columns(self, samples: list):
+        """
+        Adds a column for each of the samples that is not stored yet, and
+        returns the positions of these samples in the list and their columns.
+        """
+        keep = [j for j, sample in enumerate(samples) if sample not in self.samples]
+        columns = []
+        for j in keep:
+            columns.append(len(self.samples))
+            self.samples[samples[j]] = columns[-1]
+        self._reserve(len(self.transcripts), len(self.samples))
+        return keep, columns
+
+    def write(self, columns: list, names: list, scores: np.ndarray):
+        """
+        Stores a transcripts x columns block of scores, e.g. a chunk of the
+        rows of a merged matrix.
+        """
+        if not columns:
+            return
+        rows = self._rows(names)
+        self._reserve(len(self.transcripts), len(self.samples))
+        for k, column in enumerate(columns):
+            self._map[rows, column] = scores[:, k]
+
+    def add_sample(self, sample: str, names: list, scores: np.ndarray):
+        """
+        Stores the scores of the transcripts of a sample. A sample is only
+        stored once.
+        """
+        _, columns = self.new_columns([sample])
+        self.write(columns, names, scores[:, np.newaxis])
+
+    def statistics(self, low_threshold: float = 50, outlier_z: float = 3.0):
+        """
+        Computes, reading the matrix in blocks of samples, the number of
+        samples, mean, standard deviation, number of scores below
+        low_threshold and number of outliers (scores more than outlier_z
+        standard deviations away from the mean) of each transcript.
+        Returns them as a dictionary of arrays in the order of the
+        transcript index.
+        """
+        rows, cols = self.shape
+        step = self._block_columns(rows)
+        n = np.zeros(rows)
+        total = np.zeros(rows)
+        squares = np.zeros(rows)
+        low = np.zeros(rows, dtype=np.int64)
+        for block in self._blocks(step):
+            finite = np.isfinite(block)
+            block = np.where(finite, block, 0.0)
+            n += finite.sum(axis=1)
+            total += block.sum(axis=1)
+            squares += (block**2).sum(axis=1)
+            low += (finite & (block < low_threshold)).sum(axis=1)
+
+        # Scores lie between 0 and 100, so the sums of squares in float64
+        # lose no significant precision
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = total / n
+            variance = np.maximum(squares - n * mean**2, 0.0) / (n - 1)
+        sd = np.sqrt(variance)
+
+        # Second pass, once the means and standard deviations are known
+        outliers = np.zeros(rows, dtype=np.int64)
+        for block in self._blocks(step):
+            with np.errstate(invalid="ignore"):
+                outliers += (
+                    np.abs(block - mean[:, np.newaxis]) > outlier_z * sd[:, np.newaxis]
+                ).sum(axis=1)
+
+        return {
+            "samples": n.astype(np.int64),
+            "mean": mean,
+            "sd": sd,
+            "low": low,
+            "outliers": outliers,
+        }
+
+    def _block_columns(self, rows: int):
+        """
+        Number of samples read at once to read about BLOCK_BYTES.
+        """
+        return max(1, BLOCK_BYTES // (4 * max(rows, 1)))
+
+    def _blocks(self, step: int):
+        """
+        Yields the used matrix in blocks of step samples, as float64.
+        """
+        rows, cols = self.shape
+        for start in range(0, cols, step):
+            yield np.asarray(
+                self._map[:rows, start : min(cols, start + step)], dtype=np.float64
+            )
+
+    def save(self, directory: str, overwrite: bool = False):
+        """
+        Writes the used matrix to tin_scores.npy in directory, readable with
+        numpy.load(mmap_mode="r"), and its transcript and sample labels to
+        tin_scores_labels.npz. Unless overwrite is set, existing outputs of
+        another run are kept, and the matrix is written to the first free
+        tin_scores_<n>.npy instead, as MultiQC numbers its reports. Returns
+        the path of the matrix.
+        """
+        rows, cols = self.shape
+        name = "tin_scores"
+        path = os.path.join(directory, name + ".npy")
+        number = 0
+        while True:
+            try:
+                # Claims the name, also against a concurrent run
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                if overwrite:
+                    break
+            number += 1
+            name = f"tin_scores_{number}"
+            path = os.path.join(directory, name + ".npy")
+        out = np.lib.format.open_memmap(
+            path, mode="w+", dtype=np.float32, shape=(rows, cols), fortran_order=True
+        )
+        step = self._block_columns(rows)
+        for start in range(0, cols, step):
+            stop = min(cols, start + step)
+            out[:, start:stop] = self._map[:rows, start:stop]
+        out.flush()
+        del out
+        np.savez(
+            os.path.join(directory, name + "_labels.npz"),
+            transcripts=np.array(list(self.transcripts), dtype=str),
+            samples=np.array(list(self.samples), dtype=str),
+        )
+        return path
+
+    def close(self):
+        """
+        Unmaps and deletes the working file of the matrix, and its
+        temporary directory.
+        """
+        self._map = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
@@ -0,0 +1,202 @@
+"""
+Principal component coordinates of a PCA.
+
+The coordinates of all samples are stored once as a samples x components
+array. The scatter plot data of a pair of components is only built when
+that pair is plotted, and only for the pairs selected for the report.
+
+For PCAs with very many samples, reduced_scatter_data() keeps the report
+small: outliers and labelled samples stay individual points while the
+remaining samples are either thinned out evenly across the plane ("thin")
+or aggregated into one point per occupied grid cell ("density").
+"""
+
+from __future__ import print_function
+from itertools import combinations
+
+import numpy as np
+
+# Point colours of the reduced scatter plots: samples kept individually and
+# the lightest and darkest colours of the density gradient
+HIGHLIGHT_COLOR = "#e6550d"
+DENSITY_COLORS = ((198, 219, 239), (8, 48, 107))
+
+
+class PcaCoordinates(object):
+    """
+    Samples x components coordinates of a PCA together with the percentage
+    of variance explained by each component (NaN where unknown).
+    """
+
+    def __init__(self, samples: list, components: list, coordinates: np.ndarray):
+        self.samples = samples
+        self.components = components
+        self.coordinates = coordinates
+        self.explained = np.full(len(components), np.nan)
+
+    def set_explained_variance(self, variance: dict):
+        """
+        Stores the percentage of explained variance of the components
+        from a {component: percentage} dictionary.
+        """
+        for i, component in enumerate(self.components):
+            self.explained[i] = variance.get(component, np.nan)
+
+    def label(self, i: int):
+        """
+        Axis label of a component.
+        """
+        if np.isnan(self.explained[i]):
+            return self.components[i]
+        return f"{self.components[i]} ({self.explained[i]}% variance explained)"
+
+    def pairs(self, top: int = 3, names: list = None):
+        """
+        Lazily yields the (i, j) column pairs to plot: the given pairs of
+        component names if any, otherwise all pairs among the top
+        components by explained variance, in component order.
+        """
+        if names:
+            index = {component: i for i, component in enumerate(self.components)}
+            for x, y in names:
+                if x in index and y in index:
+                    yield index[x], index[y]
+            return
+
+        # Components without a known variance rank last, in file order
+        variance = np.nan_to_num(self.explained, nan=-np.inf)
+        selected = np.sort(np.argsort(-variance, kind="stable")[:top])
+        for i, j in combinations(selected.tolist(), 2):
+            yield i, j
+
+    def scatter_data(self, i: int, j: int, color: str):
+        """
+        Builds the scatter plot data of components i and j.
+        """
+        xs = self.coordinates[:, i].tolist()
+        ys = self.coordinates[:, j].tolist()
+        return {
+            sample: {"x": x, "y": y, "color": color}
+            for sample, x, y in zip(self.samples, xs, ys)
+        }
+
+    def reduced_scatter_data(
+        self,
+        i: int,
+        j: int,
+        color: str,
+        mode: str = "thin",
+        max_points: int = 2000,
+        bins: int = 50,
+        outlier_z: float = 4.0,
+        keep: np.ndarray = None,
+    ):
+        """
+        Builds the scatter plot data of components i and j for a large
+        PCA. Outliers (robust z-score above outlier_z on either axis) and
+        the samples flagged in keep are plotted individually; the other
+        samples are thinned to about max_points points in "thin" mode or
+        aggregated on a bins x bins grid in "density" mode.
+        """
+        x, y = self.coordinates[:, i], self.coordinates[:, j]
+        single = _outliers(x, y, outlier_z)
+        if keep is not None:
+            single |= keep
+
+        data = {
+            self.samples[k]: {
+                "x": float(x[k]),
+                "y": float(y[k]),
+                "color": HIGHLIGHT_COLOR,
+            }
+            for k in np.flatnonzero(single).tolist()
+        }
+        rest = np.flatnonzero(~single)
+        if not len(rest):
+            return data
+
+        # The grid spans the remaining points only, so that a few far
+        # outliers do not squeeze all other points into a handful of cells
+        cells = _grid_cells(x[rest], y[rest], bins)
+
+        if mode == "density":
+            occupied, inverse, counts = np.unique(
+                cells, return_inverse=True, return_counts=True
+            )
+            inverse = inverse.ravel()
+            xs = np.bincount(inverse, weights=x[rest]) / counts
+            ys = np.bincount(inverse, weights=y[rest]) / counts
+            colors = _gradient(np.log1p(counts) / np.log1p(counts.max()))
+            for cell, cx, cy, n, c in zip(
+                occupied.tolist(), xs.tolist(), ys.tolist(), counts.tolist(), colors
+            ):
+                data[f"cell {cell}: {n} samples"] = {"x": cx, "y": cy, "color": c}
+        else:
+            for k in rest[_thin(cells, max_points)].tolist():
+                data[self.samples[k]] = {
+                    "x": float(x[k]),
+                    "y": float(y[k]),
+                    "color": color,
+                }
+
+        return data
+
+
+def _outliers(x: np.ndarray, y: np.ndarray, z: float):
+    """
+    Flags the points whose robust z-score (distance to the median in units
+    of the scaled median absolute deviation) exceeds z on either axis.
+    """
+    flags = np.zeros(len(x), dtype=bool)
+    for values in (x, y):
+        deviation = np.abs(values - np.median(values))
+        mad = 1.4826 * np.median(deviation)
+        if mad > 0:
+            flags |= deviation / mad > z
+    return flags
+
+
+def _grid_cells(x: np.ndarray, y: np.ndarray, bins: int):
+    """
+    Returns the index of the cell of a bins x bins grid spanning the points
+    that each point falls into.
+    """
+    cells = np.zeros(len(x), dtype=np.intp)
+    for values in (x, y):
+        low, high = values.min(), values.max()
+        span = high - low if high > low else 1.0
+        index = np.minimum(((values - low) / span * bins).astype(np.intp), bins - 1)
+        cells = cells * bins + index
+    return cells
+
+
+def _thin(cells: np.ndarray, limit: int):
+    """
+    Stratified thinning: returns a boolean mask keeping about limit points,
+    the same fraction in every grid cell but at least one per occupied cell,
+    evenly spread over the points of a cell in their original order.
+    """
+    if len(cells) <= limit:
+        return np.ones(len(cells), dtype=bool)
+    order = np.argsort(cells, kind="stable")
+    occupied, first, counts = np.unique(
+        cells[order], return_index=True, return_counts=True
+    )
+    quota = np.maximum(np.rint(counts * (limit / len(cells))), 1).astype(np.intp)
+
+    # Rank of each point within its cell; point r of a cell with n points
+    # and quota q is kept when it starts a new multiple of n / q
+    cell = np.repeat(np.arange(len(occupied)), counts)
+    rank = np.arange(len(cells)) - first[cell]
+    mask = np.zeros(len(cells), dtype=bool)
+    mask[order] = (rank * quota[cell]) % counts[cell] < quota[cell]
+    return mask
+
+
+def _gradient(levels: np.ndarray):
+    """
+    Maps levels between 0 and 1 to hex colours of the density gradient.
+    """
+    low, high = (np.array(c, dtype=float) for c in DENSITY_COLORS)
+    rgb = np.rint(low + levels[:, np.newaxis] * (high - low)).astype(int)
+    return ["#{:02x}{:02x}{:02x}".format(*c) for c in rgb]
@@ -0,0 +1,158 @@
+"""
+Principal component analysis of a genes x samples count matrix.
+
+For a quick look at a project before its PCA has been run, the zpca module
+also computes a PCA from a matrix of read counts:
+
+1. the counts are streamed into a float32 genes x samples matrix in a
+   memory-mapped file, summing the library size of each sample on the way
+2. the counts are turned into log2(CPM + 1) a block of genes at a time and
+   the genes with the highest variance across the samples are selected
+3. the coordinates of the samples on the principal components of the
+   centred, highly variable genes are computed by randomized truncated SVD
+
+Only the highly variable genes x samples block is held in memory, so the
+count matrix does not need to fit in memory.
+"""
+
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# Number of bytes of the count matrix read at once
+BLOCK_BYTES = 1 << 24
+
+
+class CountMatrix(object):
+    """
+    Genes x samples float32 matrix of read counts in a memory-mapped file,
+    created in a temporary directory (within directory if given), with
+    the library size of each sample. Genes are appended a chunk at a time.
+    """
+
+    def __init__(self, samples: list, directory: str = None):
+        self.samples = samples
+        self.tmpdir = tempfile.mkdtemp(prefix="zpca_counts_", dir=directory)
+        self.path = os.path.join(self.tmpdir, "counts.f32")
+        self.genes = 0
+        self.library_sizes = np.zeros(len(samples))
+        self._fh = open(self.path, "wb")
+        self._map = None
+
+    def append(self, counts: np.ndarray):
+        """
+        Appends a genes x samples chunk of counts. Missing counts are 0.
+        """
+        counts = np.nan_to_num(counts, nan=0.0)
+        self.library_sizes += counts.sum(axis=0)
+        self._fh.write(np.ascontiguousarray(counts, dtype=np.float32).tobytes())
+        self.genes += len(counts)
+
+    def _matrix(self):
+        """
+        Maps the matrix once all genes are appended.
+        """
+        if self._map is None:
+            self._fh.close()
+            self._map = np.memmap(
+                self.path,
+                dtype=np.float32,
+                mode="r",
+                shape=(self.genes, len(self.samples)),
+            )
+        return self._map
+
+    def blocks(self):
+        """
+        Yields the log2(CPM + 1) values of the matrix in blocks of genes.
+        """
+        matrix = self._matrix()
+        step = max(1, BLOCK_BYTES // (8 * max(len(self.samples), 1)))
+        for start in range(0, self.genes, step):
+            yield log_cpm(matrix[start : start + step], self.library_sizes)
+
+    def rows(self, genes: np.ndarray):
+        """
+        Returns the log2(CPM + 1) values of the given genes (sorted rows).
+        """
+        return log_cpm(self._matrix()[genes], self.library_sizes)
+
+    def close(self):
+        """
+        Unmaps and deletes the file of the matrix and its directory.
+        """
+        self._fh.close()
+        self._map = None
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+def log_cpm(counts: np.ndarray, library_sizes: np.ndarray):
+    """
+    Converts a genes x samples block of counts to log2(CPM + 1). Samples
+    without reads are 0.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cpm = np.asarray(counts, dtype=np.float64) * (1e6 / library_sizes)
+    return np.log2(np.where(np.isfinite(cpm), cpm, 0.0) + 1.0)
+
+
+def highly_variable_genes(matrix: CountMatrix, top: int):
+    """
+    Returns the sorted rows of the top genes by variance of their
+    log2(CPM + 1) across the samples.
+    """
+    variances = np.concatenate([block.var(axis=1) for block in matrix.blocks()])
+    if top >= len(variances):
+        return np.arange(len(variances))
+    return np.sort(np.argpartition(-variances, top - 1)[:top])
+
+
+def randomized_pca(
+    data: np.ndarray,
+    components: int,
+    oversamples: int = 10,
+    iterations: int = 4,
+    seed: int = 0,
+):
+    """
+    Computes the principal components of the rows (observations) of data
+    by randomized truncated SVD of the column-centred data (Halko et al.,
+    2011), with a fixed seed so that reports are reproducible. Returns the
+    observations x components coordinates and the percentage of the total
+    variance explained by each component. The sign of each component is
+    set so that its largest loading is positive.
+    """
+    centred = data - data.mean(axis=0)
+    rank = min(components + oversamples, *centred.shape)
+
+    rng = np.random.default_rng(seed)
+    basis, _ = np.linalg.qr(centred @ rng.standard_normal((centred.shape[1], rank)))
+    # Power iterations, orthonormalised at each step for numerical stability
+    for _ in range(iterations):
+        basis, _ = np.linalg.qr(centred.T @ basis)
+        basis, _ = np.linalg.qr(centred @ basis)
+    u, s, vt = np.linalg.svd(basis.T @ centred, full_matrices=False)
+    u, s, vt = (basis @ u)[:, :components], s[:components], vt[:components]
+
+    signs = np.sign(vt[np.arange(len(vt)), np.argmax(np.abs(vt), axis=1)])
+    signs[signs == 0] = 1.0
+    total = (centred**2).sum()
+    explained = s**2 / total * 100 if total > 0 else np.zeros(len(s))
+    return u * (s * signs), explained
+
+
+def count_matrix_pca(matrix: CountMatrix, top_genes: int = 2000, components: int = 10):
+    """
+    Computes the PCA of the samples of a count matrix from its top_genes
+    highly variable genes. Returns the samples x components coordinates
+    and the percentage of variance explained by each component, or None
+    if the matrix has less than three samples or two genes.
+    """
+    components = min(components, len(matrix.samples) - 1, matrix.genes)
+    if components < 2:
+        return None
+    genes = highly_variable_genes(matrix, top_genes)
+    return randomized_pca(matrix.rows(genes).T, min(components, len(genes)))
@@ -12,13 +12,134 @@
 ###############################################################################
 
 from __future__ import print_function
+from functools import partial
 import logging
+import os
+import re
 
-from multiqc.plots import scatter
+import numpy as np
 from multiqc.modules.base_module import BaseMultiqcModule
+from multiqc.utils import config
+
+from .components import PcaCoordinates
+from .counts import CountMatrix, count_matrix_pca
+from ..cache import ParseCache
+from ..compaction import PlotCompactor, plot_id
+from ..export import Exporter
+from ..parallel import parse_files, parse_workers
+from ..parsing import (
+    Column,
+    ParseStats,
+    Schema,
+    iter_log,
+    read_log,
+)
+from ..prefetch import Prefetcher
+from ..profiling import PhaseProfile
+
+# Initialise the logger under the "multiqc" logger so that it reaches its handlers
+log = logging.getLogger(f"multiqc.{__name__}")
+
+# Layout of the PCA.tsv and scree.tsv files: a label column followed by
+# one column per principal component
+ZPCA_SCHEMA = Schema([Column(None, str)], rest=np.float64)
+
+# Header line of both files: an empty label followed by PC1 (and PC2, ...)
+ZPCA_HEADER = re.compile(r"[^\t]*\tPC1(\t|$)")
+
+# Layout of the counts_matrix.tsv files: the gene followed by the read
+# counts of each sample, with a header line starting with the gene column
+COUNTS_SCHEMA = Schema([Column(None, str)], rest=np.float64)
+COUNTS_HEADER = re.compile(r"(gene|gene_id|gene_name|geneid)\t", re.IGNORECASE)
+
+
+def parse_zpca_pair(files: tuple, stats: ParseStats = None):
+    """
+    Parses a (scree.tsv, PCA.tsv) pair of files and returns the
+    coordinates of the PCA with the explained variance of its
+    components, or None if it has less than two components.
+    This is a module-level function so that it can run in parse workers.
+    """
+    f, f1 = files
+    data_scree = parse_scree_logs(f, stats)
+    pca = parse_zpca_logs(f1, stats)
+    if pca is not None:
+        pca.set_explained_variance(data_scree)
+    return pca
 
-# Initialise the logger
-log = logging.getLogger(__name__)
+
+def parse_scree_logs(f: dict, stats: ParseStats = None):
+    """
+    Parses Scree.tsv and returns the explained variance in
+    percentage of each principal component in a dictionary.
+    """
+    table = read_log(f, ZPCA_SCHEMA, stats=stats)
+    if not len(table):
+        return {}
+
+    exp_car_str = "Percentage of Explained Variance"
+    labels = table[0].tolist()
+    row = labels.index(exp_car_str) if exp_car_str in labels else -1
+    return {
+        component: float(table[i][row])
+        for i, component in enumerate(table.header)
+        if i > 0
+    }
+
+
+def parse_zpca_logs(f: dict, stats: ParseStats = None):
+    """
+    Parses the PCA.tsv file and returns the coordinates of
+    its samples on all components, or None if the file has
+    less than two components.
+    """
+    table = read_log(f, ZPCA_SCHEMA, stats=stats)
+    if len(table.header) < 3:
+        return None
+
+    return PcaCoordinates(
+        samples=table[0].tolist(),
+        components=table.header[1:],
+        coordinates=np.column_stack(table.columns[1:]),
+    )
+
+
+def parse_count_matrix(
+    f: dict, stats: ParseStats = None, top_genes: int = 2000, components: int = 10
+):
+    """
+    Streams a genes x samples count matrix into a memory-mapped file and
+    returns the coordinates of the PCA of its samples, computed from the
+    top_genes highly variable genes, or None if the matrix is too small.
+    """
+    matrix = None
+    try:
+        for chunk in iter_log(f, COUNTS_SCHEMA, stats=stats):
+            if matrix is None:
+                matrix = CountMatrix(chunk.header[1:])
+            matrix.append(np.column_stack(chunk.columns[1:]))
+        result = None
+        if matrix is not None:
+            result = count_matrix_pca(matrix, top_genes, components)
+    finally:
+        if matrix is not None:
+            matrix.close()
+    if result is None:
+        return None
+
+    coordinates, explained = result
+    pca = PcaCoordinates(
+        samples=matrix.samples,
+        components=[f"PC{i + 1}" for i in range(coordinates.shape[1])],
+        coordinates=coordinates,
+    )
+    pca.set_explained_variance(
+        {
+            component: round(float(variance), 1)
+            for component, variance in zip(pca.components, explained)
+        }
+    )
+    return pca
 
 
 class MultiqcModule(BaseMultiqcModule):
@@ -41,252 +162,246 @@ class MultiqcModule(BaseMultiqcModule):
             info="- PCA analysis",
         )
 
+        # Module options, set under "zpca_config" in the MultiQC config:
+        # the number of components, by explained variance, whose pairs are
+        # plotted, or an explicit list of component pairs to plot
+        zpca_config = getattr(config, "zpca_config", {})
+        self.top_components = zpca_config.get("top_components", 3)
+        self.component_pairs = zpca_config.get("component_pairs")
+        # Large PCAs: above large_n_threshold samples the scatter plots are
+        # thinned or aggregated, keeping outliers and labelled samples
+        self.large_n_threshold = zpca_config.get("large_n_threshold", 5000)
+        self.large_n_mode = zpca_config.get("large_n_mode", "thin")
+        self.large_n_max_points = zpca_config.get("large_n_max_points", 2000)
+        self.large_n_bins = zpca_config.get("large_n_bins", 50)
+        self.outlier_z = zpca_config.get("outlier_z", 4.0)
+        self.label_samples = zpca_config.get("label_samples", [])
+        # Count matrices (opt-in): a PCA of the samples is computed from the
+        # counts_top_genes most variable genes of each count matrix found
+        self.counts_pca = zpca_config.get("counts_pca", False)
+        self.counts_top_genes = zpca_config.get("counts_top_genes", 2000)
+        self.counts_components = zpca_config.get("counts_components", 10)
+        self.parse_workers = parse_workers(zpca_config)
+        self.cache = ParseCache.from_config(getattr(config, "plugin_parse_cache", None))
+        self.profile = PhaseProfile.from_config(
+            getattr(config, "plugin_profiling", None)
+        )
+        self.exporter = Exporter.from_config(
+            getattr(config, "plugin_export", None), config.data_dir
+        )
+        self.compactor = PlotCompactor.from_config(
+            getattr(config, "plugin_compaction", None)
+        )
+        self.prefetcher = Prefetcher.from_config(
+            getattr(config, "plugin_prefetch", None)
+        )
+
+        self.parse_stats = ParseStats()
         self.number = 0
         self.findLogs()
+        if self.parse_stats.files:
+            log.info(self.parse_stats.summary())
+        if self.cache is not None:
+            log.info(self.cache.summary())
+            self.cache.close()
+        if self.exporter.written:
+            log.info(self.exporter.summary())
+        if self.compactor.plots:
+            log.info(self.compactor.summary())
+        if self.prefetcher.files:
+            log.info(self.prefetcher.summary())
+        if self.profile.enabled:
+            log.info(self.profile.summary())
+            self.write_data_file(
+                self.profile.to_dict(), "multiqc_zpca_profile", data_format="json"
+            )
 
     def findLogs(self):
         """
-        Find files matching with the regex in and passes them to the
-        parsing function one by one and also plots the graph in the end.
+        Indexes the scree and PCA files by their directory in one pass
+        over each kind, parses every matched pair once and plots the
+        graphs. Files without a partner are reported and skipped.
         """
-        for f in self.find_log_files("zpca/scree"):
-            self.number += 1
-            data_scree = self.parse_scree_logs(f)
-
-            exp_car_str = "Percentage of Explained Variance"
-            for f1 in self.find_log_files("zpca/pca"):
-                if f["root"] == f1["root"]:
-                    self.number += 1
-                    data_list = self.parse_zpca_logs(f1)
-                    if len(data_list) == 3:
-                        data_pc1_pc2, data_pc1_pc3, data_pc2_pc3 = (
-                            data_list[0],
-                            data_list[1],
-                            data_list[2],
-                        )
-                        config_pc1_pc2 = {
-                            "xlab": (
-                                f"PC1 ({data_scree['PC1'][exp_car_str]}% variance"
-                                " explained)"
-                            ),
-                            "ylab": (
-                                f"PC2 ({data_scree['PC2'][exp_car_str]}% variance"
-                                " explained)"
-                            ),
-                        }
-                        config_pc1_pc3 = {
-                            "xlab": (
-                                f"PC1 ({data_scree['PC1'][exp_car_str]}% variance"
-                                " explained)"
-                            ),
-                            "ylab": (
-                                f"PC3 ({data_scree['PC3'][exp_car_str]}% variance"
-                                " explained)"
-                            ),
-                        }
-                        config_pc2_pc3 = {
-                            "xlab": (
-                                f"PC2 ({data_scree['PC2'][exp_car_str]}% variance"
-                                " explained)"
-                            ),
-                            "ylab": (
-                                f"PC3 ({data_scree['PC3'][exp_car_str]}% variance"
-                                " explained)"
-                            ),
-                        }
-
-                        self.add_section(
-                            name="PCA components: 1 & 2",
-                            anchor="zpca",
-                            plot=scatter.plot(data_pc1_pc2, config_pc1_pc2),
-                        )
-
-                        self.add_section(
-                            name="PCA components: 1 & 3",
-                            anchor="zpca",
-                            plot=scatter.plot(data_pc1_pc3, config_pc1_pc3),
-                        )
-
-                        self.add_section(
-                            name="PCA components: 2 & 3",
-                            anchor="zpca",
-                            plot=scatter.plot(data_pc2_pc3, config_pc2_pc3),
-                        )
-                    elif len(data_list) == 1:
-                        data_pc1_pc2 = data_list[0]
-                        config_pc1_pc2 = {
-                            "xlab": (
-                                f"PC1 ({data_scree['PC1'][exp_car_str]}% variance"
-                                " explained)"
-                            ),
-                            "ylab": (
-                                f"PC2 ({data_scree['PC2'][exp_car_str]}% variance"
-                                " explained)"
-                            ),
-                        }
-
-                        self.add_section(
-                            name="PCA components: 1 & 2",
-                            anchor="zpca",
-                            plot=scatter.plot(data_pc1_pc2, config_pc1_pc2),
-                        )
+        with self.profile.phase("find") as found:
+            scree_files = self.index_by_root("zpca/scree")
+            pca_files = self.index_by_root("zpca/pca")
+            found.files += len(scree_files) + len(pca_files)
+
+        pairs = []
+        for root, f in scree_files.items():
+            f1 = pca_files.get(root)
+            if f1 is None:
+                log.warning(f"No PCA.tsv found for {os.path.join(root, f['fn'])}")
+                continue
+            pairs.append((f, f1))
+
+        with self.profile.phase("parse", stats=self.parse_stats):
+            parsed = parse_files(
+                parse_zpca_pair,
+                pairs,
+                self.parse_workers,
+                self.parse_stats,
+                cache=self.cache,
+                namespace="zpca",
+                prefetcher=self.prefetcher,
+            )
+        for (_, f1), pca in zip(pairs, parsed):
+            self.number += 2
+            if pca is not None:
+                self.add_pca(
+                    pca,
+                    os.path.basename(f1["root"]),
+                    os.path.join(f1["root"], f1["fn"]),
+                )
+
+        for root, f1 in pca_files.items():
+            if root not in scree_files:
+                log.warning(f"No scree.tsv found for {os.path.join(root, f1['fn'])}")
+
+        if self.counts_pca:
+            self.findCountMatrices()
 
         if self.number == 0:
             raise UserWarning
 
-    def parse_scree_logs(self, f: dict):
+    def findCountMatrices(self):
         """
-        Parses Scree.tsv and returns explained variance
-        in percentage of principal components in a dictionary.
+        Computes the PCA of the samples of each count matrix found and
+        plots it like the PCA files.
         """
-        word = []
-        words = []
-        listToStr = []
-
-        # Using \t as a seperator for elements in tsv file
-        for char in f["f"]:
-            if char != "\t" and char != "\n":
-                word.append(char)
-            else:
-                words.append(word)
-                word = []
-
-        # Adding each element of the tsv file in a list
-        for k in words:
-            listToStr.append("".join([str(elem) for elem in k]))
-
-        """
-        Appropriate function is called depending upon whether
-        the required components (PC_3_comp_list, PC_2_comp_list)
-        are present in tsv file(listToStr).
-        """
-        PC_3_comp_list = ["PC1", "PC2", "PC3"]
-        PC_2_comp_list = ["PC1", "PC2"]
-        if all(elem in listToStr for elem in PC_3_comp_list):
-            return self._parse_scree_helper_3(listToStr)
-        if all(elem in listToStr for elem in PC_2_comp_list):
-            return self._parse_scree_helper_2(listToStr)
-        else:
-            return {}
-
-    def _parse_scree_helper_3(self, listToStr):
+        with self.profile.phase("find") as found:
+            found_files = list(self.find_log_files("zpca/counts", filecontents=False))
+            files = []
+            for f, match in zip(
+                found_files, self.prefetcher.sniff(found_files, COUNTS_HEADER)
+            ):
+                if not match:
+                    log.debug(
+                        f"Skipping {os.path.join(f['root'], f['fn'])}: no gene column"
+                    )
+                    continue
+                files.append(f)
+            found.files += len(files)
+
+        # The PCA is computed while the matrix is streamed, in the parse phase
+        with self.profile.phase("parse", stats=self.parse_stats):
+            parsed = parse_files(
+                partial(
+                    parse_count_matrix,
+                    top_genes=self.counts_top_genes,
+                    components=self.counts_components,
+                ),
+                files,
+                self.parse_workers,
+                self.parse_stats,
+                cache=self.cache,
+                namespace=f"zpca/counts:top_genes={self.counts_top_genes}:"
+                f"components={self.counts_components}",
+                prefetcher=self.prefetcher,
+            )
+        for f, pca in zip(files, parsed):
+            self.number += 1
+            if pca is None:
+                log.warning(
+                    f"Too few samples or genes for a PCA in "
+                    f"{os.path.join(f['root'], f['fn'])}"
+                )
+                continue
+            log.info(
+                f"PCA of the {len(pca.samples)} samples of the count matrix "
+                f"{os.path.join(f['root'], f['fn'])}"
+            )
+            self.add_pca(
+                pca,
+                os.path.join(os.path.basename(f["root"]), f["fn"]),
+                os.path.join(f["root"], f["fn"]),
+            )
+
+    def add_pca(self, pca: PcaCoordinates, name: str, source: str):
         """
-        Helper function which will parse scree logs for 3 components.
+        Exports the coordinates of a PCA and plots them. The name of the
+        PCA, after the folder (and count matrix) it comes from, identifies
+        its export and plots, and the path of its source file is stored in
+        the export.
         """
-        exp_car_str = "Percentage of Explained Variance"
-        scree_data = {
-            "PC1": {exp_car_str: float(listToStr[-3])},
-            "PC2": {exp_car_str: float(listToStr[-2])},
-            "PC3": {exp_car_str: float(listToStr[-1])},
-        }
-        return scree_data
-
-    def _parse_scree_helper_2(self, listToStr):
+        with self.profile.phase("export"):
+            self.exporter.write(
+                "multiqc_zpca_{}_components".format(re.sub(r"[^\w-]+", "_", name)),
+                pca.samples,
+                pca.components,
+                {"coordinates": pca.coordinates},
+                columns_name="components",
+                extra={"explained_variance": pca.explained, "source": source},
+            )
+        with self.profile.phase("sections"):
+            self.print_zpca_charts(pca, name)
+
+    def index_by_root(self, sp_key: str):
         """
-        Helper function which will parse scree logs for 2 components.
+        Returns a dictionary of the files found for a search pattern
+        keyed by their directory. Only the header line of the files is
+        read, to skip files of other tools with the same name.
         """
-        exp_car_str = "Percentage of Explained Variance"
-        scree_data = {
-            "PC1": {exp_car_str: float(listToStr[-2])},
-            "PC2": {exp_car_str: float(listToStr[-1])},
-        }
-        return scree_data
+        found = list(self.find_log_files(sp_key, filecontents=False))
+        files = dict()
+        for f, match in zip(found, self.prefetcher.sniff(found, ZPCA_HEADER)):
+            if not match:
+                log.debug(f"Skipping {os.path.join(f['root'], f['fn'])}: no PC1 column")
+                continue
+            files[f["root"]] = f
+        return files
 
-    def parse_zpca_logs(self, f: dict):
+    def print_zpca_charts(self, pca: PcaCoordinates, name: str):
         """
-        Parses the PCA.tsv file by storing the values of ZPCA in
-        a dictionary and returns three dictionaries which will
-        directly be used to plot the graphs in findLogs().
+        Takes in the coordinates of a PCA and passes the selected pairs
+        of components to MultiQC function to print the graphs, with
+        plot IDs made of the name of the PCA and the components.
         """
-        word = []
-        words = []
-        listToStr = []
-
-        # Using \t as a seperator for elements in tsv file
-        for char in f["f"]:
-            if char != "\t" and char != "\n":
-                word.append(char)
+        # Deferred until there is a plot, as the plot modules import matplotlib
+        from multiqc.plots import scatter
+
+        large = len(pca.samples) > self.large_n_threshold
+        if large:
+            log.info(
+                f"{len(pca.samples)} samples in PCA, plotting them in "
+                f"'{self.large_n_mode}' mode"
+            )
+            keep = self.labelled_samples(pca.samples)
+
+        for i, j in pca.pairs(top=self.top_components, names=self.component_pairs):
+            if large:
+                data = pca.reduced_scatter_data(
+                    i,
+                    j,
+                    "#58a0c3",
+                    mode=self.large_n_mode,
+                    max_points=self.large_n_max_points,
+                    bins=self.large_n_bins,
+                    outlier_z=self.outlier_z,
+                    keep=keep,
+                )
             else:
-                words.append(word)
-                word = []
-
-        # Adding each element of the tsv file in a list
-        for k in words:
-            listToStr.append("".join([str(elem) for elem in k]))
-
-        """
-        Appropriate function is called depending upon whether
-        the required components (PC_3_comp_list, PC_2_comp_list)
-        are present in tsv file(listToStr).
-        """
-        PC_3_comp_list = ["PC1", "PC2", "PC3"]
-        PC_2_comp_list = ["PC1", "PC2"]
-        if all(elem in listToStr for elem in PC_3_comp_list):
-            return self._parse_zpca_helper_3(listToStr)
-        if all(elem in listToStr for elem in PC_2_comp_list):
-            return self._parse_zpca_helper_2(listToStr)
-        else:
-            return []
-
-    def _parse_zpca_helper_3(self, listToStr: list):
-        """
-        Helper function which will parse logs with 3 components.
-        """
-        data_dict = {}
+                data = pca.scatter_data(i, j, "#58a0c3")
 
-        for i_num in range(0, len(listToStr), 4):
-            if i_num == 0:
-                continue
-            data_dict[listToStr[i_num]] = [
-                listToStr[i_num + 1],
-                listToStr[i_num + 2],
-                listToStr[i_num + 3],
-            ]
-
-        data_pc1_pc2 = dict()
-        data_pc1_pc3 = dict()
-        data_pc2_pc3 = dict()
-
-        for i in data_dict:
-            data_pc1_pc2[i] = {
-                "x": float(data_dict[i][0]),
-                "y": float(data_dict[i][1]),
-                "color": "#58a0c3",
-            }
-            data_pc1_pc3[i] = {
-                "x": float(data_dict[i][0]),
-                "y": float(data_dict[i][2]),
-                "color": "#58a0c3",
-            }
-            data_pc2_pc3[i] = {
-                "x": float(data_dict[i][1]),
-                "y": float(data_dict[i][2]),
-                "color": "#58a0c3",
+            config = {
+                "id": plot_id("zpca", name, pca.components[i], pca.components[j]),
+                "xlab": pca.label(i),
+                "ylab": pca.label(j),
             }
-
-        return [data_pc1_pc2, data_pc1_pc3, data_pc2_pc3]
-
-    def _parse_zpca_helper_2(self, listToStr: list):
+            data = self.compactor.scatter(config["id"], data, config)
+            x, y = (pca.components[k].replace("PC", "") for k in (i, j))
+            self.add_section(
+                name=f"PCA components: {x} & {y}",
+                anchor="zpca",
+                plot=scatter.plot(data, config),
+            )
+
+    def labelled_samples(self, samples: list):
         """
-        Helper function which will parse logs with 2 components.
+        Flags the samples matching one of the "label_samples" regular
+        expressions, which are always plotted as individual points.
         """
-        data_dict = {}
-
-        for i_num in range(0, len(listToStr), 3):
-            if i_num == 0:
-                continue
-            data_dict[listToStr[i_num]] = [
-                listToStr[i_num + 1],
-                listToStr[i_num + 2],
-            ]
-
-        data_pc1_pc2 = dict()
-
-        for i in data_dict:
-            data_pc1_pc2[i] = {
-                "x": float(data_dict[i][0]),
-                "y": float(data_dict[i][1]),
-                "color": "#58a0c3",
-            }
-
-        return [data_pc1_pc2]
+        if not self.label_samples:
+            return np.zeros(len(samples), dtype=bool)
+        pattern = re.compile("|".join(f"(?:{p})" for p in self.label_samples))
+        return np.array([bool(pattern.search(s)) for s in samples], dtype=bool)
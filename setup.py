@@ -14,7 +14,8 @@ setup(
     license="Apache 2.0",
     packages=find_packages(),
     include_package_data=True,
-    install_requires=["multiqc"],
+    install_requires=["multiqc", "numpy"],
+    extras_require={"arrow": ["pyarrow"]},
     entry_points={
         "multiqc.modules.v1": [
             "ALFA = modules.ALFA:MultiqcModule",
@@ -22,6 +23,7 @@ setup(
             "zpca = modules.zpca:MultiqcModule",
         ],
         "multiqc.hooks.v1": ["execution_start = modules.hook:execution_start"],
+        "console_scripts": ["multiqc-plugins-cache = modules.cache:main"],
     },
     classifiers=[
         "Development Status :: 4 - Beta",